@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 RackTop Systems.
+
+"""
+Measure how healthcheck.py scales with the size of the system.
+
+Each topology in TOPOLOGIES is simulated with simulate.py and the whole suite
+is run against it. Wall time, peak RSS and the number of commands spawned
+are reported for the suite, and the time taken by each check. Checks run
+concurrently in one process, so the peak RSS and the commands spawned by
+each check are measured by running it alone, once. Results are compared to
+baseline.json, failing when any of them got worse by more than the
+tolerance, or when a run fails; --update saves them as the new baseline
+instead. Like healthcheck.py, this runs under Python 2.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import simulate
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HEALTHCHECK = os.path.join(os.path.dirname(BENCH_DIR), "healthcheck.py")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+TOPOLOGIES = [
+    ("small",   simulate.topology(shelves=1, pools=1)),
+    ("medium",  simulate.topology(shelves=8, pools=4, sensors=128,
+        log_lines=100000)),
+    ("large",   simulate.topology(shelves=40, pools=16, sensors=512,
+        log_lines=1000000, slow={"hwadm": 0.5, "fmdump": 0.5})),
+]
+
+# Checks faster than this are not compared, their timing is mostly noise.
+MIN_CHECK_SECONDS = 0.01
+
+def run_once(python, root, options=()):
+    """ Run the suite against root, returning its measurements """
+    open(os.path.join(root, "spawns.log"), "w").close()
+    state = os.path.join(root, "state")
+    if os.path.isdir(state):
+        shutil.rmtree(state)
+    started = time.time()
+    argv = [python, HEALTHCHECK, "--root", root, "--state-dir", state,
+        "--format", "jsonl"] + list(options)
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.time() - started
+    # healthcheck.py exits 0 whether checks pass or fail, anything else is a
+    # crash, whose results are not to be compared, nor saved as a baseline.
+    if status != 0:
+        raise RuntimeError("%s exited with %s" % (" ".join(argv),
+            "status %d" % os.WEXITSTATUS(status) if os.WIFEXITED(status)
+            else "signal %d" % os.WTERMSIG(status)))
+    checks = [json.loads(line) for line in output.splitlines()]
+    with open(os.path.join(root, "spawns.log")) as f:
+        spawns = sum(1 for _ in f)
+    return {
+        "wall": round(wall, 3),
+        # Kilobytes on Linux, the largest of the process and its children.
+        "max_rss": usage.ru_maxrss,
+        "spawns": spawns,
+        "failed": sorted(c["name"] for c in checks
+            if c["status"] not in ("passed", "skipped")),
+        "checks": dict((c["name"], c["duration"]) for c in checks),
+    }
+
+def measure(python, topo, repeat, alone=True):
+    """ Run the suite repeat times against topo, keeping the best run, then
+    each check alone if asked to """
+    root = tempfile.mkdtemp(prefix="healthcheck-bench.")
+    try:
+        simulate.create(root, topo)
+        runs = [run_once(python, root) for _ in range(repeat)]
+        best = min(runs, key=lambda r: r["wall"])
+        best["max_rss"] = min(r["max_rss"] for r in runs)
+        best["checks"] = dict((name, min(r["checks"][name] for r in runs))
+            for name in best["checks"])
+        if alone:
+            best["check_rss"] = {}
+            best["check_spawns"] = {}
+            for name in sorted(best["checks"]):
+                run = run_once(python, root, ["--check", name])
+                best["check_rss"][name] = run["max_rss"]
+                best["check_spawns"][name] = run["spawns"]
+    finally:
+        shutil.rmtree(root)
+    return best
+
+def compare(name, result, baseline, tolerance):
+    """ Return how result regressed from baseline, as a list of messages """
+    problems = ["%s: %s failed" % (name, check)
+        for check in result["failed"]]
+    if baseline is None:
+        return problems
+    def worse(now, then, minimum=0):
+        return now > max(then, minimum) * (1 + tolerance)
+    if worse(result["wall"], baseline["wall"]):
+        problems.append("%s: wall time %.3fs, was %.3fs" % (
+            name, result["wall"], baseline["wall"]))
+    if worse(result["max_rss"], baseline["max_rss"]):
+        problems.append("%s: peak RSS %dKB, was %dKB" % (
+            name, result["max_rss"], baseline["max_rss"]))
+    if result["spawns"] > baseline["spawns"]:
+        problems.append("%s: %d commands spawned, was %d" % (
+            name, result["spawns"], baseline["spawns"]))
+    for check in sorted(set(baseline["checks"]) - set(result["checks"])):
+        problems.append("%s: %s did not run" % (name, check))
+    for check, elapsed in sorted(result["checks"].items()):
+        then = baseline["checks"].get(check)
+        if then is not None and worse(elapsed, then, MIN_CHECK_SECONDS):
+            problems.append("%s: %s took %.3fs, was %.3fs" % (
+                name, check, elapsed, then))
+    for check, rss in sorted(result.get("check_rss", {}).items()):
+        then = baseline.get("check_rss", {}).get(check)
+        if then is not None and worse(rss, then):
+            problems.append("%s: %s alone peaked at %dKB, was %dKB" % (
+                name, check, rss, then))
+    for check, spawns in sorted(result.get("check_spawns", {}).items()):
+        then = baseline.get("check_spawns", {}).get(check)
+        if then is not None and spawns > then:
+            problems.append("%s: %s alone spawned %d commands, was %d" % (
+                name, check, spawns, then))
+    return problems
+
+def report(name, result, stream):
+    stream.write("%-8s wall %7.3fs  peak RSS %8dKB  spawns %4d\n" % (
+        name, result["wall"], result["max_rss"], result["spawns"]))
+    slowest = sorted(result["checks"].items(), key=lambda c: c[1],
+        reverse=True)
+    for check, elapsed in slowest[:5]:
+        stream.write("         %7.3fs  %s\n" % (elapsed, check))
+    largest = sorted(result.get("check_rss", {}).items(),
+        key=lambda c: c[1], reverse=True)
+    for check, rss in largest[:5]:
+        stream.write("         %7dKB %4d spawns  %s\n" % (rss,
+            result["check_spawns"][check], check))
+    stream.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark healthcheck.py on simulated systems.")
+    parser.add_argument("--python", default=sys.executable,
+        help="Python 2 interpreter to run healthcheck.py with " \
+            "(default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs of each topology, the best one counts " \
+            "(default: %(default)d)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+        help="fraction by which a measurement may exceed the baseline " \
+            "(default: %(default)g)")
+    parser.add_argument("--only", metavar="TOPOLOGY", action="append",
+        help="only run the given topology, may be repeated")
+    parser.add_argument("--suite-only", action="store_true",
+        help="do not run each check alone to measure its peak RSS and " \
+            "the commands it spawns")
+    parser.add_argument("--update", action="store_true",
+        help="save the results as the new baseline")
+    args = parser.parse_args(argv)
+    if sys.version_info[0] != 2:
+        parser.error("run with Python 2, as the simulated commands and " \
+            "healthcheck.py are")
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    results = {}
+    problems = []
+    for name, topo in TOPOLOGIES:
+        if args.only and name not in args.only:
+            continue
+        try:
+            results[name] = measure(args.python, topo, args.repeat,
+                not args.suite_only)
+        except RuntimeError as e:
+            sys.stdout.write("FAILED: %s: %s\n" % (name, e))
+            return 1
+        report(name, results[name], sys.stdout)
+        problems.extend(compare(name, results[name], baseline.get(name),
+            args.tolerance))
+
+    if args.update:
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=1, sort_keys=True,
+                separators=(",", ": "))
+            f.write("\n")
+        return 0
+    for problem in problems:
+        sys.stdout.write("REGRESSION: %s\n" % problem)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
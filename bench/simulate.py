@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2018 RackTop Systems.
+
+"""
+Simulate the commands healthcheck.py runs, on a system of any size.
+
+    python simulate.py ROOT [--shelves N] [--pools N] [--latency SECONDS]
+
+creates below ROOT stand-ins for hwadm, secadm, bsradm, myrackadm, ipmitool,
+kstat, svcs, zpool, zfs, fmadm and fmdump, along with the system files the
+checks read, so that `healthcheck.py --root ROOT` runs against a healthy
+system of the given topology. Each stand-in sleeps for its latency before
+answering and appends its command line to ROOT/spawns.log.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import stat
+import sys
+import time
+
+# Where each command lives, relative to the root.
+COMMANDS = {
+    "hwadm":        "usr/racktop/sbin",
+    "secadm":       "usr/racktop/sbin",
+    "bsradm":       "usr/racktop/sbin",
+    "myrackadm":    "usr/racktop/sbin",
+    "ipmitool":     "usr/bin",
+    "kstat":        "usr/bin",
+    "svcs":         "usr/bin",
+    "zpool":        "usr/sbin",
+    "zfs":          "usr/sbin",
+    "fmadm":        "usr/sbin",
+    "fmdump":       "usr/sbin",
+}
+
+BAYS_PER_SHELF = 60
+
+CHASSIS_STATUS = """System Power         : on
+Power Overload       : false
+Power Interlock      : inactive
+Main Power Fault     : false
+Power Control Fault  : false
+Power Restore Policy : previous
+Last Power Event     :
+Chassis Intrusion    : inactive
+Front-Panel Lockout  : inactive
+Drive Fault          : false
+Cooling/Fan Fault    : false
+"""
+
+PROFILES = {"bp/etc": "sysconfig_filesystem", "bp/var": "system"}
+
+def serial(i):
+    return "SIM%05d" % i
+
+def device(i):
+    return "c0t5000CCA%09Xd0" % i
+
+def drive(i, registered):
+    return {
+        "Make": "HGST", "Model": "HUH721010AL5200", "Serial": serial(i),
+        "Wwn": "5000cca%09x" % i, "StorageUnitId": "5000ccb%09x" % i,
+        "DeviceName": device(i), "Path": "/dev/rdsk/%ss0" % device(i),
+        "HWInfo": {
+            "RegistrationTimestamp": registered,
+            "RegistrationStatus": "Registered", "ReadyStatus": "Ready",
+            "Bay": i % BAYS_PER_SHELF, "Enclosure": i // BAYS_PER_SHELF,
+            "CelsiusTemperature": 35, "MaxFunctionalTemp": 60,
+            "Type": "HDD", "PowerOnDuration": 8760, "Rpm": 7200,
+        },
+        "OSInfo": dict([("Capacity", 10 << 40)] + [(counter, 0)
+            for counter in ("SoftErrors", "HardErrors", "TransportErrors",
+                "MediaError", "DeviceNotReady", "NoDevice", "Recoverable",
+                "IllegalRequest", "PredictiveFailureAnalysis")]),
+    }
+
+def hwadm(topo, args):
+    registered = datetime.datetime.now().strftime("%Y-01-01T00:00:00.000Z")
+    units = [{
+        "Serial": "BSH0000001", "PartNumber": "GXY124S2V",
+        "IsHeadUnit": True, "DriveBays": None,
+        "Paths": [], "Sensors": [
+            {"Name": "PS1", "Type": "Power", "Status": "OK"},
+            {"Name": "PS2", "Type": "Power", "Status": "OK"}],
+    }]
+    for shelf in range(topo["shelves"]):
+        units.append({
+            "Serial": "SHL%07d" % shelf, "PartNumber": "H4060-J",
+            "IsHeadUnit": False,
+            "Paths": ["c%dt0" % shelf, "c%dt1" % shelf],
+            "Sensors": [{"Name": "Fan%d" % n, "Type": "Fan", "Status": "OK"}
+                for n in range(8)],
+            "DriveBays": [{"BayNumber": bay, "Status": "OK", "Problems": None,
+                "FaultLedOn": False, "IdentifyLedOn": False}
+                for bay in range(BAYS_PER_SHELF)],
+        })
+    return json.dumps({"Drives": [drive(i, registered)
+        for i in range(topo["drives"])], "Units": units})
+
+def secadm(topo, args):
+    drives = [{"Serial": serial(i), "Status": "NotEnrolled",
+        "Rekeying": False, "AutoUnlock": False, "Refreshing": False,
+        "LastActionPending": False, "ReadyStatus": "Ready", "Problems": None}
+        for i in range(topo["drives"])]
+    # The first two drives make up bp, the rest is shared between pools.
+    pools = [{"Name": "bp", "DriveSerials": [serial(0), serial(1)]}]
+    data = list(range(2, topo["drives"]))
+    for n in range(topo["pools"]):
+        pools.append({"Name": "pool%d" % n,
+            "DriveSerials": [serial(i) for i in data[n::topo["pools"]]]})
+    return json.dumps({"Drives": drives, "Pools": pools})
+
+def bsradm(topo, args):
+    return {
+        "-j smb": json.dumps({"IsVm": False,
+            "Manufacturer": "RackTop Systems", "Product": "BrickStor",
+            "SystemFamily": "BrickStor", "BaseboardPartNumber": "S2600WTTR",
+            "ChassisType": "RackMountChassis", "IsValidHardware": True,
+            "BaseboardSerial": "BQWL00000000", "SystemSerial": "SIM0",
+            "Uuid": "00000000-0000-0000-0000-000000000000"}),
+        "-j dns domain get": json.dumps({"result": "example.com"}),
+        "-j os installed": json.dumps([{"Guid": "0"}]),
+        "-j os": json.dumps({"BootGuid": "dba9947551e0e39790c68660ed248775"}),
+    }[" ".join(args)]
+
+def myrackadm(topo, args):
+    return json.dumps({"Host": "0000-0000"})
+
+def ipmitool(topo, args):
+    sdr = json.dumps({"IPMISDRDUMP": [{"Name": "Sensor %d" % n,
+        "Health": "ok", "Value": 40} for n in range(topo["sensors"])]})
+    answers = {"chassis status": CHASSIS_STATUS, "sdr jlist": sdr}
+    if args[0] == "exec":
+        with open(args[1]) as f:
+            lines = [line.strip() for line in f if line.strip()]
+    else:
+        lines = [" ".join(args)]
+    return "".join("Success\n" if line.startswith("user test")
+        else answers[line] for line in lines)
+
+def kstat(topo, args):
+    # The error counters are the ones healthcheck.py reads, the rest of the
+    # statistics are there as in the sderr kstats of a real drive.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from healthcheck import SDERR_COUNTERS
+    return json.dumps([{"module": "sderr", "instance": i,
+        "class": "device_error", "name": "sd%d,err" % i,
+        "data": dict([(name, 0) for name in SDERR_COUNTERS] +
+            [("Serial No", serial(i)), ("Vendor", "HGST    "),
+            ("Product", "HUH721010AL5200"), ("Revision", "A21D"),
+            ("Size", 10000831348736)])}
+        for i in range(topo["drives"])])
+
+def svcs(topo, args):
+    if args == ["-xv"]:
+        return ""
+    return "".join("online         svc:/racktop/%s:default\n" % service
+        for service in args[3:])
+
+def zpool(topo, args):
+    # Laid out as print_status_config in libzfs does, a tab and then two
+    # spaces for each level below the pool.
+    rows = [(0, "bp"), (1, "mirror-0")] + [(2, "%ss0" % device(i))
+        for i in (0, 1)]
+    width = max([10] + [len(name) + 2 * depth for depth, name in rows])
+    config = "".join("\t%s%-*s  %-8s %5s %5s %5s\n" % ("  " * depth,
+        width - 2 * depth, name, "ONLINE", 0, 0, 0) for depth, name in rows)
+    return """  pool: bp
+ state: ONLINE
+  scan: none requested
+config:
+
+\t%-*s  %-8s %5s %5s %5s
+%s
+errors: No known data errors
+""" % (width, "NAME", "STATE", "READ", "WRITE", "CKSUM", config)
+
+def zfs(topo, args):
+    datasets = args[args.index("racktop:storage_profile") + 1:]
+    return "".join("%s\tracktop:storage_profile\t%s\tlocal\n" % (
+        d, PROFILES.get(d, "-")) for d in datasets)
+
+def fmadm(topo, args):
+    return ""
+
+def fmdump(topo, args):
+    return "TIME                 CLASS\n"
+
+def answer(root, name, args):
+    """ Run as the stand-in for command name below root """
+    with open(os.path.join(root, "topology.json")) as f:
+        topo = json.load(f)
+    with open(os.path.join(root, "spawns.log"), "a") as f:
+        f.write("%s\n" % " ".join([name] + args))
+    time.sleep(topo["latency"].get(name, topo["latency"]["default"]))
+    sys.stdout.write(globals()[name](topo, args))
+
+def create(root, topo):
+    """ Lay out a simulated system of topology topo below root """
+    for name, directory in COMMANDS.items():
+        directory = os.path.join(root, directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec %s %s --answer %s %s \"$@\"\n" % (
+                sys.executable, os.path.abspath(__file__), root, name))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    for directory in ("var/adm", "var/cores"):
+        if not os.path.isdir(os.path.join(root, directory)):
+            os.makedirs(os.path.join(root, directory))
+    with open(os.path.join(root, "var/adm/messages"), "w") as f:
+        for n in range(topo["log_lines"]):
+            f.write("Jan  1 00:00:%02d sim genunix: [ID 0 kern.notice] " \
+                "simulated message %d\n" % (n % 60, n))
+    with open(os.path.join(root, "topology.json"), "w") as f:
+        json.dump(topo, f, indent=1)
+    open(os.path.join(root, "spawns.log"), "w").close()
+
+def topology(shelves=1, pools=1, sensors=32, log_lines=1000, latency=0.05,
+    slow=None):
+    """ Describe a system, latency maps command names to seconds """
+    latencies = {"default": latency}
+    latencies.update(slow or {})
+    return {"shelves": shelves, "drives": max(shelves * BAYS_PER_SHELF, 12),
+        "pools": pools, "sensors": sensors, "log_lines": log_lines,
+        "latency": latencies}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--answer"]:
+        return answer(argv[1], argv[2], argv[3:])
+    parser = argparse.ArgumentParser(
+        description="Simulate the commands run by healthcheck.py.")
+    parser.add_argument("root", help="directory to create the system in")
+    parser.add_argument("--shelves", type=int, default=1,
+        help="number of 60-bay shelves, all bays populated " \
+            "(default: %(default)d)")
+    parser.add_argument("--pools", type=int, default=1,
+        help="number of SED pools sharing the drives (default: %(default)d)")
+    parser.add_argument("--sensors", type=int, default=32,
+        help="number of BMC sensors (default: %(default)d)")
+    parser.add_argument("--log-lines", type=int, default=1000,
+        help="number of lines in the kernel log (default: %(default)d)")
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="seconds each command takes (default: %(default)g)")
+    parser.add_argument("--slow", metavar="COMMAND=SECONDS",
+        action="append", default=[],
+        help="latency of a single command, may be repeated")
+    args = parser.parse_args(argv)
+    slow = dict((name, float(seconds)) for name, seconds in
+        (spec.split("=", 1) for spec in args.slow))
+    create(os.path.abspath(args.root), topology(args.shelves, args.pools,
+        args.sensors, args.log_lines, args.latency, slow))
+
+if __name__ == '__main__':
+    sys.exit(main())
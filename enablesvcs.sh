@@ -8,12 +8,12 @@
 # or binary forms except in compliance with the RTCL. You can obtain a copy at
 # http://racktopsystems.com/legal/rtcl.txt.
 
-services=(
-    "datareplicationd"
-    "dataprotectiond"
-    "secured"
-)
+# Services come from the table of expected service states in healthcheck.py,
+# which is kept next to this script, where they are marked to be enabled.
+healthcheck="$(dirname "$0")/healthcheck.py"
 
-for s in "${services[@]}"; do
+services=$(python "$healthcheck" --list-services-to-enable) || exit 1
+
+for s in $services; do
     svcadm enable "$s"
 done
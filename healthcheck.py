@@ -22,187 +22,2035 @@
 #
 # Copyright 2018 RackTop Systems.
 
+import argparse
+import array
+import atexit
 import base64
-import cStringIO
+import BaseHTTPServer
+import collections
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import mmap
+import multiprocessing
 import os
+import pipes
+import pstats
+import re
+import select
+import signal
+import socket
+import SocketServer
+import struct
 import subprocess
 from subprocess import PIPE
 import sys
+import threading
+import time
+import traceback
 import unittest
 import json
-from threading import Timer
+import xml.sax.saxutils
+import zipfile
 
 os_guid = u"dba9947551e0e39790c68660ed248775"
 
 ERR_NOT_POSSIBLE = "I am a virtual machine, this test is not possible!"
 
-class BasicSystemSanity(unittest.TestCase):
-    _hwinfo_drives     = []
-    _hwinfo_units = []
-    _hwinfo_all = []
-    _sedinfo    = []
-    _smbiosinfo = []
-
-    _shelf_model_bay_count = {
-        u'H4060-J': 60,
-        u'SP-3424-E12EBD': 24,
-        u'SBX24LC-ECEBD': 24,
-        u'GXY124S2V': 0,
-        u'GXY108S2V': 0,
-    }
-
-    @classmethod
-    def enclosure_bay_count_ok(cls, model, count):
-        if model not in cls._shelf_model_bay_count:
-            return False
-        if cls._shelf_model_bay_count[model] != count:
-            return False
-        return True
-    
-    def iam_virtual(self):
-        return self.smbiosinfo[u'IsVm']
-
-    def known_drive_vendor(self, mfg):
-        m = {
-            "hgst": 1,
-            "hitachi": 1,
-            "seagate": 1,
-        }
-        return mfg.lower() in m
-
-    def skip_drive_ok(self, make):
-        should_skip = ("ata") # Add others here in the future
-        for entry in should_skip:
-            if entry in make.lower():
-                return True
-        return False
-
-    def drive_is_from_bp(self, serial):
-        pools = self.sedinfo[u'Pools']
-        for pool in pools:
-            for this_serial in pool[u'DriveSerials']:
-                if serial == this_serial:
-                    return True
-        return False
-
-    def drive_type_sensible(self, t):
-        return t.lower() in ("ssd", "hdd")
-    
-    def drive_is_mechanical(self, t):
-        return t.lower() == "hdd"
-
-    def drive_is_solid_state(self, t):
-        return t.lower() == "sdd"
-
-    def exec_with_timeout(self, cmd, timeout):
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE # Unused for now
-        )
-        timer = Timer(timeout, proc.kill)
+# Number of checks executed concurrently by default. Nearly all of the time
+# spent in a check is waiting on an external command, so this can be a good
+# deal larger than the number of CPUs.
+DEFAULT_JOBS = 8
+
+# Seconds after which the daemon collects a fact again, unless the fact says
+# otherwise.
+DEFAULT_REFRESH = 60
+
+# Where state kept between runs, such as log checkpoints, is saved.
+STATE_DIR = "/var/tmp/healthcheck"
+
+# Directory the commands run and the system files read are found below,
+# changed with --root to run against a simulated system.
+ROOT = "/"
+
+KERNEL_LOG = "/var/adm/messages"
+
+# Severities of kernel messages which fail the system log check, each with
+# the pattern matching its syslog priority.
+KERNEL_LOG_SEVERITIES = (
+    ("warning",     r"kern\.warn"),
+    ("error",       r"kern\.(?:err|crit|alert|emerg)"),
+)
+
+# Seconds of history the checks on trends look back over.
+HISTORY_WINDOW = 24 * 3600
+
+# Seconds between the runs added to the history. Runs closer to the last one
+# added are checked against the history without being added to it, unless
+# they are early by no more than a tenth of the interval.
+HISTORY_INTERVAL = 300
+
+# Runs kept in the history of each series, 8 bytes each, enough to cover the
+# window when every run is as early as it may be.
+HISTORY_RUNS = HISTORY_WINDOW * 10 // (HISTORY_INTERVAL * 9) + 1
+
+# Degrees Celsius a drive may warm up by within the history window.
+TEMPERATURE_RISE = 10
+
+# Seconds without further changes to watched files before checks run again.
+WATCH_DEBOUNCE = 1.0
+
+# Error events read from fmdump, enough to show what is going on.
+FMDUMP_EVENTS = 20
+
+# Known false positives among kernel messages, extended with --log-allow.
+KERNEL_LOG_ALLOW = [
+    r"ddrx104", # ddrdrive
+]
+
+# Where the time of the run is accounted when --profile was given.
+PROFILER = None
+
+# Seconds a command may run before it is killed, unless its fact allows
+# otherwise.
+COMMAND_TIMEOUT = 60
+
+# Time by which the whole run must be over, set with --deadline. Commands
+# still running then are killed, and checks which did not finish within
+# DEADLINE_GRACE seconds more are reported as timed out.
+DEADLINE = None
+DEADLINE_GRACE = 2
+
+# Command output kept between runs for facts which allow it, see ResultCache.
+CACHE = None
+
+class SourceUnavailable(Exception):
+    """ A shared data source could not be collected """
+    pass
+
+class CommandTimeout(Exception):
+    """ A command, or a check, ran past its timeout or the run deadline """
+    pass
+
+class Supervisor(object):
+    """ Kill child processes which outlive their deadline.
+
+    Children are started in a process group of their own and watched until
+    released. A single reaper thread sleeps until the earliest deadline, and
+    kills the whole group of any child still watched by then, so that
+    neither a hung command nor anything it started outlasts it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._children = {}
+        self._order = itertools.count()
+        self._thread = None
+        self._stopped = False
+
+    def watch(self, proc, deadline):
+        with self._cond:
+            self._children[proc] = False
+            heapq.heappush(self._heap, (deadline, next(self._order), proc))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._reap)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def release(self, proc):
+        """ Stop watching a child, returning whether it was killed """
+        with self._cond:
+            return self._children.pop(proc, False)
+
+    def stop(self):
+        """ Stop the reaper thread, so that it is not left running while the
+        interpreter tears down the modules it uses on exit """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _reap(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, proc = heapq.heappop(self._heap)
+                    if self._children.get(proc) is False:
+                        self._children[proc] = True
+                        try:
+                            os.killpg(proc.pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+                self._cond.wait(self._heap[0][0] - now if self._heap
+                    else None)
+
+SUPERVISOR = Supervisor()
+atexit.register(SUPERVISOR.stop)
+
+class Budget(object):
+    """ Share of the deadline of the run given to each command.
+
+    What is left of the deadline is divided by the rounds the jobs take to
+    collect the sources read from a command which were not collected yet, so
+    that a hung command cannot use up the time of all the others, while the
+    last ones may use whatever the first left.
+    """
+    def __init__(self, sources, jobs):
+        self.sources = sources
+        self.jobs = jobs
+
+    def collected(self):
+        self.sources -= 1
+
+    def deadline(self, now):
+        rounds = max(1, (self.sources + self.jobs - 1) // self.jobs)
+        return now + (DEADLINE - now) / rounds
+
+# Budget of the suite being run, if it has a deadline.
+BUDGET = None
+
+def _deadline(timeout):
+    """ Return when something allowed to run for timeout seconds from now
+    must be over, within its share of the deadline of the run """
+    now = time.time()
+    deadline = now + timeout
+    if DEADLINE is None:
+        return deadline
+    if BUDGET is not None:
+        deadline = min(deadline, BUDGET.deadline(now))
+    return min(deadline, DEADLINE)
+
+def _rooted(path):
+    """ Return an absolute path relocated below ROOT """
+    if ROOT == "/" or not os.path.isabs(path):
+        return path
+    return os.path.join(ROOT, path.lstrip("/"))
+
+def uses(*sources):
+    """ Declare the facts a check reads.
+
+    Facts are prefetched before the check runs. Checks reading a shared data
+    source which could not be collected are skipped rather than run against
+    missing data.
+    """
+    def decorator(func):
+        func.sources = sources
+        return func
+    return decorator
+
+def tags(*names):
+    """ Tag a check, so that it can be selected along with others of its kind
+    with --tag """
+    def decorator(func):
+        func.tags = names
+        return func
+    return decorator
+
+def check_tags(test):
+    """ Return the tags of a test, if any """
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    return getattr(method, 'tags', ())
+
+def check_sources(test):
+    """ Return the facts declared by a test, if any """
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    return getattr(method, 'sources', ())
+
+class Profiler(object):
+    """ Account where the time of a run went.
+
+    Commands are timed from spawning to exiting, along with the number of
+    bytes they wrote, facts by the time spent parsing that output, and checks
+    by the time spent waiting for their facts and asserting on them. With
+    `cprofile` every thread running checks or collecting facts is also run
+    under cProfile, and the statistics of all of them are merged.
+    """
+    def __init__(self, cprofile=False):
+        self.cprofile = cprofile
+        self._lock = threading.Lock()
+        self._profiles = []
+        self.commands = []
+        self.facts = collections.OrderedDict()
+        self.checks = collections.OrderedDict()
+
+    def command(self, argv, spawn, wait, size, status):
+        with self._lock:
+            self.commands.append((argv, spawn, wait, size, status))
+
+    def fact(self, name, **times):
+        with self._lock:
+            self.facts.setdefault(name, {}).update(times)
+
+    def check(self, name, **times):
+        with self._lock:
+            self.checks.setdefault(name, {}).update(times)
+
+    def wrap(self, func):
+        """ Return func running under cProfile, if statistics are kept """
+        if not self.cprofile:
+            return func
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+            return profile.runcall(func, *args, **kwargs)
+        return profiled
+
+    def dump_stats(self, path):
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+    def report(self, stream, limit=15):
+        """ Write the slowest commands, facts and checks, slowest first """
+        with self._lock:
+            commands = sorted(self.commands,
+                key=lambda c: c[1] + c[2], reverse=True)
+            facts = sorted(self.facts.items(),
+                key=lambda f: f[1].get("parse", 0), reverse=True)
+            checks = sorted(self.checks.items(),
+                key=lambda c: c[1].get("wait", 0) + c[1].get("assert", 0),
+                reverse=True)
+        stream.write("Slowest commands:\n")
+        stream.write("%8s %8s %10s %6s  %s\n" % (
+            "spawn", "wait", "bytes", "status", "command"))
+        for argv, spawn, wait, size, status in commands[:limit]:
+            stream.write("%8.3f %8.3f %10d %6s  %s\n" % (spawn, wait, size,
+                status, " ".join(pipes.quote(a) for a in argv)))
+        stream.write("\nSlowest facts:\n")
+        stream.write("%8s %10s  %s\n" % ("parse", "bytes", "fact"))
+        for name, times in facts[:limit]:
+            stream.write("%8.3f %10s  %s\n" % (times.get("parse", 0),
+                times.get("bytes", "-"), name))
+        stream.write("\nSlowest checks:\n")
+        stream.write("%8s %8s %8s  %s\n" % ("total", "wait", "assert",
+            "check"))
+        for name, times in checks[:limit]:
+            wait = times.get("wait", 0)
+            elapsed = times.get("assert", 0)
+            stream.write("%8.3f %8.3f %8.3f  %s\n" % (wait + elapsed, wait,
+                elapsed, name))
+        stream.flush()
+
+def _profiled(func):
+    """ Return func running under cProfile when the run is profiled """
+    return func if PROFILER is None else PROFILER.wrap(func)
+
+class Fact(object):
+    """ A named piece of information collected from an external command.
+
+    `parse` turns the command output into the value shared by checks, None
+    keeps the raw output. Facts which are not read from a command instead
+    have a `collect` function, called with the store, returning the value.
+
+    A fact with an `error` message is a shared data source: when it cannot be
+    collected the message, or one from `hints` matching the exit status, is
+    reported and the checks reading it are skipped. Failures of other facts
+    are raised in the checks reading them.
+
+    A command is killed after `timeout` seconds, COMMAND_TIMEOUT by default,
+    which fails the fact unless `partial` output is good enough. Output of a
+    command slow to run and rarely changing may be reused by later runs for
+    `cache` seconds. A command reading `input` on stdin is given it. Commands
+    of facts sharing a `lock` name never run at once, even across runs.
+    Output is read a line at a time when only its first `lines` lines are
+    needed, and the command is stopped as soon as it printed more. A fact
+    read from files lists in `paths` those whose changes make it stale.
+
+    `refresh` is how many seconds the daemon keeps using a collected value.
+    A fact computed from other facts lists them in `needs`, and is refreshed
+    along with any of them.
+    """
+    def __init__(self, name, argv=None, parse=json.loads, timeout=None,
+        check=True, error=None, hints=None, collect=None,
+        refresh=DEFAULT_REFRESH, needs=(), partial=False, cache=None,
+        input=None, lock=None, lines=None, paths=()):
+        self.name = name
+        self.refresh = refresh
+        self.needs = needs
+        self.argv = argv
+        self.collect = collect
+        self.parse = parse
+        self.timeout = timeout
+        self.partial = partial
+        self.cache = cache
+        self.input = input
+        self.lock = lock
+        self.lines = lines
+        self.paths = paths
+        self.check = check
+        self.error = error
+        self.hints = hints or {}
+
+    @property
+    def skip_unavailable(self):
+        return self.error is not None
+
+class _Entry(object):
+    __slots__ = ('event', 'value', 'error', 'time', 'duration')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.time = None
+        self.duration = None
+
+class FactStore(object):
+    """ Memoized, thread-safe store of facts collected during a run.
+
+    Each distinct command line is run at most once per store, and each fact
+    is parsed once with the result shared between all checks. A request for
+    something still being collected waits for the collection in flight
+    instead of starting another process.
+    """
+    def __init__(self, facts=None):
+        self.facts = FACTS if facts is None else facts
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Whether collecting facts may update state kept between runs.
+        self.keeps_state = True
+        # Age of the output of facts served from the on-disk cache.
+        self.cached = {}
+
+    def _memoize(self, key, func):
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _Entry()
+        if owner:
+            started = time.time()
+            try:
+                entry.value = func()
+            except Exception as e:
+                entry.error = e
+            finally:
+                entry.time = time.time()
+                entry.duration = entry.time - started
+                entry.event.set()
+        else:
+            entry.event.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.value
+
+    def _exec_with_timeout(self, cmd, timeout=None, partial=False,
+        input=None, lines=None, **kwargs):
+        """ Return the exit status and stdout of a command.
+
+        The command, and everything it started, is killed once it ran for
+        timeout seconds, COMMAND_TIMEOUT by default, or the run is past its
+        deadline. That raises CommandTimeout, unless partial output will do.
+        With `lines`, only that many lines of output are read and the command
+        is killed if it prints more, its status is then None.
+        """
+        started = time.time()
+        if timeout is None:
+            timeout = COMMAND_TIMEOUT
+        deadline = _deadline(timeout)
+        if deadline <= started:
+            raise CommandTimeout("%s: not run, past the deadline" % cmd[0])
+        proc = subprocess.Popen([_rooted(cmd[0])] + list(cmd[1:]),
+            stdin=None if input is None else PIPE, stdout=subprocess.PIPE,
+            preexec_fn=os.setsid, **kwargs)
+        spawned = time.time()
+        SUPERVISOR.watch(proc, deadline)
         try:
-            timer.start()
-            stdout, _ = proc.communicate()
+            if lines is None:
+                stdout, _ = proc.communicate(input)
+                status = proc.returncode
+            else:
+                stdout, status = self._read_lines(proc, lines, input)
         finally:
-            if timer.isAlive():
-                timer.cancel()
-        return stdout
-
-    @classmethod
-    def hwinfo_drives(cls):
-        return cls._hwinfo_drives
-
-    @classmethod
-    def hwinfo_units(cls):
-        return cls._hwinfo_units
-
-    @classmethod
-    def sedinfo(cls):
-        return cls._sedinfo
-
-    @classmethod
-    def smbiosinfo(cls):
-        return cls._smbiosinfo
-
-    @classmethod
-    def setUpClass(cls):
-        # We will refer to this information multiple times.
+            killed = SUPERVISOR.release(proc)
+        if PROFILER is not None:
+            PROFILER.command(cmd, spawned - started, time.time() - spawned,
+                len(stdout), "killed" if killed else
+                "stopped" if status is None else status)
+        if killed and not partial:
+            raise CommandTimeout("%s: killed after %.1fs" % (
+                cmd[0], time.time() - started))
+        return status, stdout
+
+    @staticmethod
+    def _read_lines(proc, lines, input=None):
+        # Read output as it comes, and stop the command once it printed more
+        # than needed, however much more it would have printed.
+        if input is not None:
+            proc.stdin.write(input)
+            proc.stdin.close()
+        output = []
+        for line in iter(proc.stdout.readline, b""):
+            if len(output) == lines:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                break
+            output.append(line)
+        proc.stdout.close()
+        status = proc.wait()
+        return b"".join(output), None if len(output) == lines and \
+            status == -signal.SIGKILL else status
+
+    def run(self, argv, timeout=None, check=True, partial=False, input=None,
+        lines=None):
+        """ Return stdout of a command, running it at most once.
+
+        With `partial`, whatever output the command produced before it was
+        killed for running too long is returned regardless of exit status.
+        With `lines`, at most that many lines of output are returned, and the
+        command is stopped once it printed more. The same command line is
+        expected to always get the same `input` and `lines`.
+        """
+        def execute():
+            if partial:
+                with open(os.devnull, "wb") as devnull:
+                    return self._exec_with_timeout(argv, timeout,
+                        partial=True, input=input, lines=lines,
+                        stderr=devnull)[1]
+            status, stdout = self._exec_with_timeout(argv, timeout,
+                input=input, lines=lines)
+            # A command stopped early has no exit status to check.
+            if check and status not in (0, None):
+                raise subprocess.CalledProcessError(status, argv, stdout)
+            return stdout
+        return self._memoize(('run',) + tuple(argv), execute)
+
+    def _unavailable(self, message):
+        sys.stderr.write("ERROR: %s\n" % message)
+        sys.stderr.flush()
+        return SourceUnavailable(message)
+
+    def _collect(self, fact):
+        if fact.collect is not None:
+            started = time.time()
+            value = fact.collect(self)
+            if PROFILER is not None:
+                PROFILER.fact(fact.name, parse=time.time() - started)
+            return value
         try:
-            output = subprocess.check_output(
-                ["/usr/racktop/sbin/hwadm", "-j", "ls", "a"]
-            )
+            output = self._output(fact)
         except subprocess.CalledProcessError as e:
-            if e.returncode == 1:
-                sys.stderr.write(
-                    "ERROR: hwd service is probably no running, " \
-                    "check with: 'svcs hwd'\n")
-                sys.stderr.flush()
+            if fact.error is None:
+                raise
+            raise self._unavailable(
+                fact.hints.get(e.returncode, fact.error))
+        except OSError:
+            if fact.error is None:
+                raise
+            raise self._unavailable(fact.error)
+        if fact.parse is None:
+            return output
+        started = time.time()
+        value = fact.parse(output)
+        if PROFILER is not None:
+            PROFILER.fact(fact.name, parse=time.time() - started,
+                bytes=len(output))
+        return value
+
+    def _output(self, fact):
+        def run():
+            with _exclusive(fact.lock):
+                return self.run(fact.argv, fact.timeout, fact.check,
+                    fact.partial, fact.input, fact.lines)
+        if CACHE is None or fact.cache is None:
+            return run()
+        output, age = CACHE.get(fact.argv, fact.cache, run)
+        if age is not None:
+            self.cached[fact.name] = age
+        return output
+
+    def get(self, name):
+        """ Return the parsed value of a fact, collecting it if necessary """
+        fact = self.facts[name]
+        return self._memoize(('fact', name), lambda: self._collect(fact))
+
+    def collect(self, name):
+        """ Collect a fact, returning None if it is available.
+
+        Otherwise the reason it is unavailable is returned. Shared data
+        sources also report their failure on stderr, once.
+        """
+        try:
+            self.get(name)
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+        return None
+
+    def outcome(self, name):
+        """ Return the value or error of a fact and the seconds it took to
+        collect, without collecting it. None until it has been collected """
+        entry = self._entries.get(('fact', name))
+        if entry is None or not entry.event.is_set():
+            return None
+        return entry.value, entry.error, entry.duration
+
+    def timed_out(self, name):
+        """ Whether collecting a fact was cut short by a timeout """
+        entry = self._entries.get(('fact', name))
+        return entry is not None and isinstance(entry.error, CommandTimeout)
+
+    def age(self, name):
+        """ Seconds since a fact was collected, None if it was not """
+        entry = self._entries.get(('fact', name))
+        if entry is None or entry.time is None:
+            return None
+        return time.time() - entry.time
+
+    def invalidate(self, name):
+        """ Forget a fact, and the output it was parsed from, so that it is
+        collected again the next time it is read """
+        fact = self.facts[name]
+        with self._lock:
+            self.cached.pop(name, None)
+            self._entries.pop(('fact', name), None)
+            if fact.argv is not None:
+                self._entries.pop(('run',) + tuple(fact.argv), None)
+
+class RecordingFactStore(FactStore):
+    """ A store which also keeps everything it collected, to be saved in a
+    bundle replayed later by ReplayFactStore.
+
+    A bundle is a zip archive holding `index.json`, which lists each command
+    run with its exit status and timing, and the value of each fact not read
+    from a command. Command output is kept beside it in `objects/`, named by
+    its SHA-256 so that identical output is stored once.
+    """
+    def __init__(self, facts=None):
+        super(RecordingFactStore, self).__init__(facts)
+        self._record_lock = threading.Lock()
+        self._commands = []
+        self._objects = {}
+        self._values = collections.OrderedDict()
+
+    def _exec_with_timeout(self, cmd, timeout=None, **kwargs):
+        started = time.time()
+        try:
+            status, stdout = super(RecordingFactStore,
+                self)._exec_with_timeout(cmd, timeout, **kwargs)
+        except OSError as e:
+            with self._record_lock:
+                self._commands.append({"argv": list(cmd), "errno": e.errno,
+                    "error": e.strerror})
+            raise
+        except CommandTimeout as e:
+            with self._record_lock:
+                self._commands.append({"argv": list(cmd), "timeout": str(e)})
+            raise
+        digest = hashlib.sha256(stdout).hexdigest()
+        with self._record_lock:
+            self._objects[digest] = stdout
+            self._commands.append({"argv": list(cmd), "status": status,
+                "stdout": digest, "elapsed": round(time.time() - started, 3)})
+        return status, stdout
+
+    def _collect(self, fact):
+        # Facts computed from others are computed again on replay.
+        if fact.collect is None or fact.needs:
+            return super(RecordingFactStore, self)._collect(fact)
+        try:
+            value = super(RecordingFactStore, self)._collect(fact)
+        except Exception as e:
+            with self._record_lock:
+                self._values[fact.name] = {"error": "%s: %s" % (
+                    e.__class__.__name__, e)}
+            raise
+        with self._record_lock:
+            self._values[fact.name] = {"value": value}
+        return value
+
+    def save(self, path):
+        """ Write everything collected so far to the bundle at path """
+        with self._record_lock:
+            index = {
+                "version": 1,
+                "hostname": socket.gethostname(),
+                "created": time.time(),
+                "commands": list(self._commands),
+                "facts": self._values.copy(),
+            }
+            objects = self._objects.copy()
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr("index.json", json.dumps(index, indent=1))
+            for digest, stdout in objects.items():
+                bundle.writestr("objects/%s" % digest, stdout)
+        _atomic_write(path, data.getvalue())
+
+class ReplayFactStore(FactStore):
+    """ A store answering from a bundle saved by RecordingFactStore, without
+    running any command.
+
+    Commands missing from the bundle fail as if they were not installed.
+    """
+    def __init__(self, path, facts=None):
+        super(ReplayFactStore, self).__init__(facts)
+        # What was recorded elsewhere is not part of the history here.
+        self.keeps_state = False
+        self.path = path
+        with zipfile.ZipFile(path) as bundle:
+            self.index = json.loads(bundle.read("index.json"))
+        self._commands = dict((tuple(command["argv"]), command)
+            for command in self.index["commands"])
+
+    def recorded(self, argv):
+        """ Return how a command ran, as listed in the index, or None """
+        return self._commands.get(tuple(argv))
+
+    def _exec_with_timeout(self, cmd, timeout=None, **kwargs):
+        command = self.recorded(cmd)
+        if command is None:
+            raise OSError(errno.ENOENT, "%s: not recorded in bundle" % (
+                " ".join(pipes.quote(a) for a in cmd)))
+        if "timeout" in command:
+            raise CommandTimeout(command["timeout"])
+        if "stdout" not in command:
+            raise OSError(command["errno"], command["error"])
+        # Output is only read from the bundle once something needs it.
+        with zipfile.ZipFile(self.path) as bundle:
+            return command["status"], bundle.read(
+                "objects/%s" % command["stdout"])
+
+    def _collect(self, fact):
+        if fact.collect is None or fact.needs:
+            return super(ReplayFactStore, self)._collect(fact)
+        recorded = self.index["facts"].get(fact.name)
+        if recorded is None:
+            raise SourceUnavailable("'%s' was not recorded in bundle" % (
+                fact.name))
+        if "error" in recorded:
+            raise RuntimeError(recorded["error"])
+        return recorded["value"]
+
+@contextlib.contextmanager
+def _exclusive(name):
+    """ Hold the lock of a name, shared by every run using STATE_DIR """
+    if name is None:
+        yield
+        return
+    directory = os.path.join(STATE_DIR, "locks")
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    with open(os.path.join(directory, "%s.lock" % name), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+class ResultCache(object):
+    """ Command output kept on disk between runs.
+
+    Each command line run below each ROOT has an entry of its own in
+    `directory`, replaced atomically. An entry is used until it is older than the time to live of
+    its fact, or than `max_age` when given, and never when `read` is false.
+    A lock per entry makes overlapping runs wait for one of them to run the
+    command, rather than all of them running it.
+    """
+    def __init__(self, directory, max_age=None, read=True):
+        self.directory = directory
+        self.max_age = max_age
+        self.read = read
+
+    def get(self, argv, ttl, compute):
+        """ Return the output of a command and its age in seconds, or None
+        for the age when the output was just computed by calling compute """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = os.path.join(self.directory,
+            hashlib.sha256(json.dumps([ROOT] + list(argv))).hexdigest())
+        with open(path + ".lock", "a") as lock:
+            # Released when the lock file is closed.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.max_age is not None:
+                ttl = self.max_age
+            if self.read:
+                try:
+                    with open(path) as f:
+                        entry = json.load(f)
+                    age = time.time() - entry["time"]
+                    if 0 <= age < ttl:
+                        return base64.b64decode(entry["stdout"]), age
+                except (IOError, ValueError, KeyError, TypeError):
+                    pass
+            output = compute()
+            _atomic_write(path, json.dumps({"time": time.time(),
+                "stdout": base64.b64encode(output)}))
+            return output, None
+
+def cache_ages(test):
+    """ Return the age of each fact a test read from the on-disk cache """
+    store = getattr(test, 'facts', None)
+    if store is None:
+        return collections.OrderedDict()
+    names = list(check_sources(test))
+    for name in names:
+        names.extend(n for n in store.facts[name].needs if n not in names)
+    return collections.OrderedDict((name, store.cached[name])
+        for name in names if name in store.cached)
+
+def _atomic_write(path, data):
+    """ Replace the contents of a file so readers never see a partial write """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    tmp = "%s.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+class LogPatterns(object):
+    """ Classify log lines by severity, ignoring known false positives """
+    def __init__(self, severities, allow):
+        self.severities = [(name, re.compile(pattern))
+            for name, pattern in severities]
+        self.allow = [re.compile(pattern) for pattern in allow]
+        self.fingerprint = hashlib.sha1(
+            json.dumps([severities, allow])).hexdigest()
+
+    def classify(self, line):
+        """ Return the severity of a line, or None if it is not counted """
+        for name, pattern in self.severities:
+            if pattern.search(line):
+                if any(p.search(line) for p in self.allow):
+                    return None
+                return name
+        return None
+
+class LogScanner(object):
+    """ Incrementally count the lines of a log matching severity patterns.
+
+    The offset reached and the counts so far are saved in a checkpoint along
+    with the identity of the log, so that each scan only reads what has been
+    appended since the previous one. A different inode, or a log shorter than
+    the offset, means the log was rotated, and it is scanned from the start.
+    """
+    chunk_size = 1 << 16
+
+    def __init__(self, path, checkpoint, patterns):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.patterns = patterns
+
+    def _load(self, st):
+        try:
+            with open(self.checkpoint, "rb") as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        # Counts saved under different patterns cannot be carried over.
+        if (state.get("fingerprint") != self.patterns.fingerprint or
+            state.get("dev") != st.st_dev or
+            state.get("inode") != st.st_ino or
+            state.get("offset", 0) > st.st_size):
+            return None
+        return state
+
+    def _save(self, state):
+        try:
+            _atomic_write(self.checkpoint, json.dumps(state))
+        except (IOError, OSError):
+            pass # Without a checkpoint the next scan starts over
+
+    def scan(self):
+        """ Return the number of matching lines in the log by severity """
+        names = [name for name, _ in self.patterns.severities]
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            state = self._load(st)
+            if state is None:
+                state = {
+                    "fingerprint": self.patterns.fingerprint,
+                    "dev": st.st_dev,
+                    "inode": st.st_ino,
+                    "offset": 0,
+                    "counts": dict((name, 0) for name in names),
+                }
+            counts = collections.Counter(state["counts"])
+            offset = state["offset"]
+            f.seek(offset)
+            partial = b""
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                lines = (partial + chunk).split(b"\n")
+                # The last element is an incomplete line, or empty.
+                partial = lines.pop()
+                for line in lines:
+                    severity = self.patterns.classify(line)
+                    if severity is not None:
+                        counts[severity] += 1
+                    offset += len(line) + 1
+        # A trailing incomplete line is picked up once it is finished.
+        state["offset"] = offset
+        state["counts"] = dict(counts)
+        self._save(state)
+        return collections.OrderedDict((name, counts[name]) for name in names)
+
+def _scan_kernel_log(store):
+    return LogScanner(_rooted(KERNEL_LOG),
+        os.path.join(STATE_DIR, "messages.checkpoint"),
+        LogPatterns(KERNEL_LOG_SEVERITIES, KERNEL_LOG_ALLOW)).scan()
+
+# `Mon DD HH:MM:SS host source: message`, the source may carry a [pid].
+_SYSLOG_LINE = re.compile(
+    r"^(\w{3}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) \S+ ([^\s:\[]+)")
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()))
+
+def _syslog_time(match, mtime):
+    # Syslog leaves out the year, take it from when the file was last
+    # written, unless that would put the line after it.
+    month = _MONTHS.get(match.group(1))
+    if month is None:
+        return None
+    fields = [int(match.group(i)) for i in range(2, 6)]
+    year = time.localtime(mtime).tm_year
+    stamp = time.mktime((year, month) + tuple(fields) + (0, 0, -1))
+    if stamp > mtime + 86400:
+        stamp = time.mktime((year - 1, month) + tuple(fields) + (0, 0, -1))
+    return stamp
+
+def kernel_log_archives(path):
+    """ Return the log followed by its rotated, possibly gzipped, archives """
+    directory, base = os.path.split(path)
+    pattern = re.compile(r"^%s(?:\.(\d+))?(?:\.gz)?$" % re.escape(base))
+    found = []
+    for name in os.listdir(directory):
+        m = pattern.match(name)
+        if m is not None:
+            rotation = -1 if m.group(1) is None else int(m.group(1))
+            found.append((rotation, name))
+    return [os.path.join(directory, name) for _, name in sorted(found)]
+
+def _audit_log_file(args):
+    # Runs in a worker process, so it only takes and returns plain data.
+    path, since, severities, allow = args
+    patterns = LogPatterns(severities, allow)
+    counts = collections.Counter()
+    lines = 0
+    mtime = os.stat(path).st_mtime
+    if path.endswith(".gz"):
+        f = io.BufferedReader(gzip.open(path, "rb"))
+    else:
+        f = io.open(path, "rb")
+    with f:
+        for line in f:
+            lines += 1
+            severity = patterns.classify(line)
+            if severity is None:
+                continue
+            m = _SYSLOG_LINE.match(line)
+            if m is not None:
+                stamp = _syslog_time(m, mtime)
+                if stamp is not None and stamp < since:
+                    continue
+                source = m.group(6)
             else:
-                sys.stderr.write(
-                    "ERROR: something unexpected happened with hwd!\n")
-            sys.exit(1)
+                source = "unknown"
+            counts[(severity, source)] += 1
+    return path, lines, counts
+
+def audit_kernel_logs(days, jobs=None, stream=sys.stdout):
+    """ Count kernel messages in the log and its archives over `days`.
+
+    Each file is streamed, and decompressed, in a pool of worker processes,
+    and the per-file counts are merged into one report by severity and
+    source. Archives last written before the window are not read at all.
+    Returns the total number of messages found.
+    """
+    since = time.time() - days * 86400
+    paths = [path for path in kernel_log_archives(_rooted(KERNEL_LOG))
+        if os.stat(path).st_mtime >= since]
+    work = [(path, since, KERNEL_LOG_SEVERITIES, KERNEL_LOG_ALLOW)
+        for path in paths]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(work))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = list(pool.imap_unordered(_audit_log_file, work))
         finally:
-            cls.hwinfo_drives = json.loads(output)[u'Drives']
-            cls.hwinfo_units = json.loads(output)[u'Units']
-
-
+            pool.terminate()
+    else:
+        results = [_audit_log_file(w) for w in work]
+
+    total = collections.Counter()
+    lines = 0
+    stream.write("Kernel log audit of the last %g days\n\n" % days)
+    for path, file_lines, counts in sorted(results):
+        lines += file_lines
+        total.update(counts)
+        stream.write("%-40s %10d lines %8d messages\n" % (
+            path, file_lines, sum(counts.values())))
+    stream.write("\n%-10s %-24s %8s\n" % ("SEVERITY", "SOURCE", "COUNT"))
+    for (severity, source), count in sorted(total.items(),
+        key=lambda item: (-item[1], item[0])):
+        stream.write("%-10s %-24s %8d\n" % (severity, source, count))
+    stream.write("\n%d messages in %d lines of %d files\n" % (
+        sum(total.values()), lines, len(results)))
+    return sum(total.values())
+
+def _list_cores(store):
+    _, _, filenames = next(os.walk(_rooted("/var/cores")))
+    return filenames
+
+def _parse_chassis_status(output):
+    # Turn each `Key Name : value` line into a ('KeyName', 'value') pair.
+    return [tuple(w.replace(' ', '').split(':'))
+        for w in output.rstrip('\n').split('\n')]
+
+def _parse_line(output):
+    return output.rstrip('\n')
+
+# Every IPMI query of a run, answered in a single ipmitool session so that the
+# BMC is only asked once. `sdr jlist` has to come last, see _split_ipmi_batch.
+IPMI_BATCH = "".join("%s\n" % query for query in [
+    "user test 2 16 %s" % base64.b64decode(b'cmFja3RvcA=='),
+    "chassis status",
+    "sdr jlist",
+])
+
+def _split_ipmi_batch(output):
+    # Queries ipmitool could not answer print nothing but an error on stderr,
+    # so each answer is told apart by its shape rather than its position:
+    # `user test` prints `Success` or `Failure: <reason>`, `chassis status`
+    # lines of `Key Name : value` and `sdr jlist` a JSON document, the last
+    # of them. Lines of no known shape belong to no answer.
+    answers = {"user": [], "chassis": [], "sdr": []}
+    lines = output.splitlines(True)
+    for idx, line in enumerate(lines):
+        if line.lstrip().startswith("{"):
+            answers["sdr"] = lines[idx:]
+            break
+        if line.strip() == "Success" or line.startswith("Failure"):
+            answers["user"].append(line)
+        elif " : " in line:
+            answers["chassis"].append(line)
+    return dict((query, "".join(answer))
+        for query, answer in answers.items())
+
+def _ipmi_answer(query, parse):
+    """ Return a collect function reading the answer to one IPMI query """
+    def collect(store):
+        answer = store.get('ipmi')[query]
+        if not answer.strip():
+            raise ValueError("ipmitool did not answer '%s'" % query)
+        return parse(answer)
+    return collect
+
+# Expected state of each service, and whether enablesvcs.sh enables it. All
+# of them are queried with a single svcs invocation, and each is reported as
+# a check of its own. enablesvcs.sh reads the services to enable from here,
+# see --list-services-to-enable.
+SMF_SERVICES = (
+    ("bsrlicensed",         "online",   False),
+    ("bsrinit",             "online",   False),
+    ("hwd",                 "online",   False),
+    ("secured",             "online",   True),
+    ("dataprotectiond",     "online",   True),
+    ("datareplicationd",    "online",   True),
+    ("bsrapid",             "online",   False),
+)
+
+def _parse_smf_states(output):
+    # Lines are `<state> <fmri>`, returns a list of (fmri, state) pairs.
+    pairs = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            pairs.append((fields[1], fields[0]))
+    return pairs
+
+def smf_fmri_matches(pattern, fmri):
+    """ Match an FMRI the way svcs matches abbreviated service names """
+    if pattern.startswith("svc:/"):
+        return fmri == pattern or fmri.startswith(pattern + ":")
+    service, _, instance = fmri[len("svc:/"):].partition(":")
+    name, _, want_instance = pattern.partition(":")
+    if want_instance and want_instance != instance:
+        return False
+    return service == name or service.endswith("/" + name)
+
+# Statistics of the sderr kstats counting errors. The others identify the
+# drive, or like `Size` are integers which count no error.
+SDERR_COUNTERS = (
+    u"Device Not Ready",
+    u"Hard Errors",
+    u"Illegal Request",
+    u"Media Error",
+    u"No Device",
+    u"Predictive Failure Analysis",
+    u"Recoverable",
+    u"Soft Errors",
+    u"Transport Errors",
+)
+
+# Expected value of dataset properties, as (dataset, property, value). All of
+# them are read with a single zfs invocation, however many datasets there are.
+DATASET_PROPERTIES = (
+    ("bp/etc",      "racktop:storage_profile",  "sysconfig_filesystem"),
+    ("bp/var",      "racktop:storage_profile",  "system"),
+)
+
+def _unique(items):
+    return list(collections.OrderedDict.fromkeys(items))
+
+def _parse_zfs_get(output):
+    # Lines are `<dataset> <property> <value> <source>` separated by tabs,
+    # returns the value of each (dataset, property).
+    values = {}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) >= 3:
+            values[(fields[0], fields[1])] = fields[2]
+    return values
+
+class Vdev(object):
+    """ A pool, or a virtual device within one, with the vdevs below it.
+
+    Errors are the READ, WRITE and CKSUM counts as zpool prints them, e.g.
+    '0' or '1.2K', empty for rows such as spares which have none.
+    """
+    __slots__ = ('name', 'health', 'errors', 'children')
+
+    def __init__(self, name, health, errors=()):
+        self.name = name
+        self.health = health
+        self.errors = tuple(errors)
+        self.children = []
+
+    def __iter__(self):
+        """ Every vdev below this one, depth first """
+        for child in self.children:
+            yield child
+            for vdev in child:
+                yield vdev
+
+# Rows of `zpool status` grouping the vdevs below them rather than being one.
+_ZPOOL_VDEV_CLASSES = ("logs", "cache", "spares", "special", "dedup")
+
+def _parse_zpool_status(output):
+    # The config of each pool is a table whose rows are indented by how deep
+    # the vdev is in the tree of the pool, starting with the pool itself.
+    # Classes of vdevs, such as logs, are at the same depth as the pool but
+    # hold the vdevs indented below them. Returns the pools by name.
+    pools = collections.OrderedDict()
+    stack = None
+    in_config = False
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields:
+            if stack:
+                in_config = False
+            continue
+        if fields[0] == "pool:" or fields[0] == "errors:":
+            stack = None
+            in_config = False
+            continue
+        if fields[0] == "config:":
+            in_config = True
+            continue
+        if not in_config or (stack is None and fields[0] == "NAME"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        vdev = Vdev(fields[0], fields[1] if len(fields) > 1 else None,
+            fields[2:5])
+        if stack is None:
+            pools[vdev.name] = vdev
+            stack = [(indent, vdev)]
+            continue
+        if indent <= stack[0][0] and vdev.name in _ZPOOL_VDEV_CLASSES:
+            indent = stack[0][0] + 1
+        while len(stack) > 1 and stack[-1][0] >= indent:
+            stack.pop()
+        stack[-1][1].children.append(vdev)
+        stack.append((indent, vdev))
+    return pools
+
+_JSON_SPACE = re.compile(r'[ \t\n\r]*')
+
+class _JsonScanner(object):
+    """ Walk a JSON document one value at a time.
+
+    Objects and arrays can be entered member by member, each value being
+    decoded, or skipped, before moving on to the next, so that a large array
+    never has to be decoded into one tree.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def peek(self):
+        """ Return the next character which is not whitespace """
+        self.pos = _JSON_SPACE.match(self.text, self.pos).end()
+        return self.text[self.pos:self.pos + 1]
+
+    def _expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '%s' at offset %d" % (char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """ Decode the value at the current position """
+        self.peek()
+        value, self.pos = self._decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def _container(self, opening, closing, member):
+        self._expect(opening)
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        while True:
+            yield member()
+            if self.peek() == closing:
+                self.pos += 1
+                return
+            self._expect(',')
+
+    def members(self):
+        """ Yield the key of each member of the object at the current
+        position. Its value is to be consumed before asking for the next """
+        def key():
+            name = self.value()
+            self._expect(':')
+            return name
+        return self._container('{', '}', key)
+
+    def elements(self):
+        """ Yield for each element of the array at the current position,
+        which is to be consumed before asking for the next """
+        return self._container('[', ']', lambda: None)
+
+    def end(self):
+        if self.peek():
+            raise ValueError("Extra data at offset %d" % self.pos)
+
+class Drive(object):
+    """ A drive as reported by hwadm, keeping only what the checks read """
+    __slots__ = ('make', 'model', 'serial', 'wwn', 'unit_id', 'device',
+        'path', 'registered', 'registration', 'ready', 'enclosure', 'bay',
+        'temperature', 'max_temperature', 'type', 'power_on', 'rpm',
+        'capacity')
+
+    def __init__(self, data):
+        hwinfo = data.get(u'HWInfo') or {}
+        osinfo = data.get(u'OSInfo') or {}
+        self.make = data.get(u'Make')
+        self.model = data.get(u'Model')
+        self.serial = data.get(u'Serial')
+        self.wwn = data.get(u'Wwn')
+        self.unit_id = data.get(u'StorageUnitId')
+        self.device = data.get(u'DeviceName')
+        self.path = data.get(u'Path')
+        self.registered = hwinfo.get(u'RegistrationTimestamp')
+        self.registration = hwinfo.get(u'RegistrationStatus')
+        self.ready = hwinfo.get(u'ReadyStatus')
+        self.enclosure = hwinfo.get(u'Enclosure')
+        self.bay = hwinfo.get(u'Bay')
+        self.temperature = hwinfo.get(u'CelsiusTemperature')
+        self.max_temperature = hwinfo.get(u'MaxFunctionalTemp')
+        self.type = hwinfo.get(u'Type')
+        self.power_on = hwinfo.get(u'PowerOnDuration')
+        self.rpm = hwinfo.get(u'Rpm')
+        self.capacity = osinfo.get(u'Capacity')
+
+class Sensor(object):
+    """ A sensor of an enclosure or the head """
+    __slots__ = ('name', 'type', 'status')
+
+    def __init__(self, data):
+        self.name = data.get(u'Name')
+        self.type = data.get(u'Type')
+        self.status = data.get(u'Status')
+
+class Bay(object):
+    """ A drive bay of an enclosure """
+    __slots__ = ('number', 'status', 'problems', 'fault_led',
+        'identify_led')
+
+    def __init__(self, data):
+        self.number = data.get(u'BayNumber')
+        self.status = data.get(u'Status')
+        self.problems = data.get(u'Problems')
+        self.fault_led = data.get(u'FaultLedOn')
+        self.identify_led = data.get(u'IdentifyLedOn')
+
+class Unit(object):
+    """ An enclosure, or the head unit, as reported by hwadm. Bays is None
+    for a unit without any, such as most heads """
+    __slots__ = ('serial', 'part_number', 'is_head', 'paths', 'sensors',
+        'bays')
+
+    def __init__(self, data):
+        self.serial = data.get(u'Serial')
+        self.part_number = data.get(u'PartNumber')
+        self.is_head = bool(data.get(u'IsHeadUnit'))
+        self.paths = tuple(data.get(u'Paths') or ())
+        self.sensors = [Sensor(sensor) for sensor in
+            data.get(u'Sensors') or ()]
+        self.bays = None
+        if data.get(u'DriveBays') is not None:
+            self.bays = [Bay(bay) for bay in data[u'DriveBays']]
+
+class Hardware(object):
+    """ The drives and units reported by hwadm """
+    __slots__ = ('drives', 'units')
+
+    def __init__(self):
+        self.drives = []
+        self.units = []
+
+def _parse_hwadm(output):
+    # The output of a head with many shelves runs to megabytes, mostly the
+    # drives. Each drive and unit is decoded on its own and only its record
+    # kept, rather than decoding the whole document into one tree first.
+    scanner = _JsonScanner(output)
+    hardware = Hardware()
+    records = {u'Drives': (hardware.drives, Drive),
+        u'Units': (hardware.units, Unit)}
+    for key in scanner.members():
+        if key in records and scanner.peek() == '[':
+            kept, record = records[key]
+            for _ in scanner.elements():
+                kept.append(record(scanner.value()))
+        else:
+            scanner.value()
+    scanner.end()
+    return hardware
+
+def _parse_sderr(output):
+    # One kstat instance per drive, named `sd<N>,err`. The table is keyed by
+    # the driver instance and holds every statistic of it, counters as well
+    # as identifying strings such as `Serial No`.
+    table = collections.OrderedDict()
+    for entry in sorted(json.loads(output), key=lambda e: e[u'instance']):
+        table[entry[u'name'].split(',')[0]] = entry[u'data']
+    return table
+
+class DriveRecord(object):
+    """ One drive as seen by hwadm, secadm and the sderr kstats.
+
+    The data of each source is kept as reported, None for a source which
+    does not know the drive.
+    """
+    __slots__ = ('serial', 'wwn', 'device', 'instance', 'enclosure', 'bay',
+        'hwadm', 'secadm', 'sderr')
+
+    def __init__(self, serial):
+        self.serial = serial
+        for name in self.__slots__[1:]:
+            setattr(self, name, None)
+
+    @property
+    def location(self):
+        return (self.enclosure, self.bay)
+
+class DriveInventory(object):
+    """ Every drive known to hwadm, secadm and the sderr kstats, joined into
+    one record per drive by serial number.
+
+    Records are indexed by serial, WWN, device name, sd instance and
+    enclosure and bay, and the members of each pool are kept as a set of
+    serials, so that any lookup takes the same time however many drives are
+    attached. Any of the sources may be missing.
+    """
+    def __init__(self, hwadm=None, secadm=None, sderr=None):
+        self.drives = []
+        self.by_serial = {}
+        self.by_wwn = {}
+        self.by_device = {}
+        self.by_instance = {}
+        self.by_location = {}
+        self.pools = {}
+        for drive in hwadm.drives if hwadm is not None else ():
+            record = self._record(drive.serial or u'')
+            record.hwadm = drive
+            record.wwn = drive.wwn
+            record.device = drive.device
+            record.enclosure = drive.enclosure
+            record.bay = drive.bay
+            if record.wwn:
+                self.by_wwn[record.wwn.lower()] = record
+            if record.device:
+                self.by_device[record.device] = record
+            if record.bay is not None:
+                self.by_location[record.location] = record
+        for drive in (secadm or {}).get(u'Drives') or ():
+            self._record(drive[u'Serial']).secadm = drive
+        for pool in (secadm or {}).get(u'Pools') or ():
+            self.pools[pool[u'Name']] = frozenset(
+                serial.strip() for serial in pool[u'DriveSerials'] or ())
+        self.pooled = frozenset().union(*self.pools.values())
+        for instance, data in (sderr or {}).items():
+            record = self._record(data.get(u'Serial No', u''))
+            record.instance = instance
+            record.sderr = data
+            self.by_instance[instance] = record
+
+    def _record(self, serial):
+        serial = serial.strip()
+        record = self.by_serial.get(serial) if serial else None
+        if record is None:
+            record = DriveRecord(serial)
+            self.drives.append(record)
+            if serial:
+                self.by_serial[serial] = record
+        return record
+
+    def __len__(self):
+        return len(self.drives)
+
+    def __iter__(self):
+        return iter(self.drives)
+
+    def find(self, key):
+        """ Return the drive with a serial, WWN, device name or sd instance
+        of key, or None """
+        for index in (self.by_serial, self.by_device, self.by_instance):
+            if key in index:
+                return index[key]
+        return self.by_wwn.get(key.lower())
+
+    def in_pool(self, serial, pool=None):
+        """ Whether a drive is a member of pool, or of any pool """
+        members = self.pooled if pool is None else self.pools.get(pool, ())
+        return serial.strip() in members
+
+def _drive_inventory(store):
+    # Join whichever sources are available, the checks reading a source which
+    # is not are skipped anyway.
+    return DriveInventory(**dict((name, store.get(name))
+        for name in FACTS['drives'].needs if store.collect(name) is None))
+
+class History(object):
+    """ Ring buffers of timestamped samples of named series, in a file.
+
+    The file holds a header, the time of each of the last `runs` runs, a
+    block for each series with its value in each of those runs, then an
+    index of the blocks: the key of the series each holds, then the first
+    and then the last run each has a value for. Runs are written at the same
+    slot of every block, which wraps around, so that appending costs the
+    same however long the history is, and the file only grows with the
+    number of series. The block of a series which got no sample within the
+    runs kept is reused for the next new one; the index moves past blocks
+    added at the end.
+
+    Series are found through the index, without going through the blocks.
+    Blocks are mapped a chunk at a time and only the slots of the runs
+    wanted are touched, so that neither the time taken nor the memory used
+    grows with the series not asked for, nor the whole file gets mapped.
+    """
+    MAGIC = b"HCHIST03"
+    HEADER = struct.Struct("<8sIIQ")    # magic, runs kept, blocks, appended
+    VALUE = struct.Struct("<d")         # a run's time, or a series' value
+    INDEX = 3 * 8                       # bytes of index for each block
+    CHUNK = 1 << 20                     # bytes of blocks mapped at once
+
+    def __init__(self, path, runs=HISTORY_RUNS):
+        self.path = path
+        self.runs = runs
+
+    @staticmethod
+    def key(name):
+        return struct.unpack("<Q", hashlib.sha1(name).digest()[:8])[0]
+
+    def _block(self, runs, n):
+        # Offset of block n, and of the index after `n` blocks.
+        return self.HEADER.size + (n + 1) * runs * self.VALUE.size
+
+    def _slot(self, runs, run):
+        return (run % runs) * self.VALUE.size
+
+    @staticmethod
+    def _read(fd, offset, size):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+    @staticmethod
+    def _write(fd, offset, data):
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+    @staticmethod
+    def _array(data):
+        values = array.array('d', data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    def _write_index(self, fd, runs, index):
+        os.lseek(fd, self._block(runs, len(index[0])), os.SEEK_SET)
+        for column in index:
+            os.write(fd, struct.pack("<%dQ" % len(column), *column))
+
+    @contextlib.contextmanager
+    def _opened(self):
+        """ Yield the file locked, with the number of runs kept and of runs
+        appended, the times of the runs kept, and the index of the blocks as
+        lists of their keys, first runs and last runs, the first run after
+        the last of blocks holding nothing """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
         try:
-            output = subprocess.check_output(
-                ["/usr/racktop/sbin/secadm", "-j", "ls", "a"]
-            )
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 1:
-                sys.stderr.write(
-                    "ERROR: secured service is probably no running, " \
-                    "check with: 'svcs secured'\n")
-                sys.stderr.flush()
-            else:
-                sys.stderr.write(
-                    "ERROR: something unexpected happened with secured!\n")
-            sys.exit(1)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            magic = self._read(fd, 0, len(self.MAGIC))
+            # Histories kept in an earlier layout start over.
+            if not magic or (magic != self.MAGIC and
+                magic.startswith(self.MAGIC[:-2])):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self._block(self.runs, 0))
+                self._write(fd, 0, self.HEADER.pack(self.MAGIC, self.runs,
+                    0, 0))
+            magic, runs, blocks, appended = self.HEADER.unpack(
+                self._read(fd, 0, self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError("%s is not a history file" % self.path)
+            times = self._array(self._read(fd, self.HEADER.size,
+                runs * self.VALUE.size))
+            data = self._read(fd, self._block(runs, blocks),
+                blocks * self.INDEX)
+            index = [list(struct.unpack_from("<%dQ" % blocks, data,
+                column * blocks * 8)) for column in range(3)]
+            yield fd, runs, appended, times, index
+        finally:
+            os.close(fd)
+
+    def _mapped(self, fd, runs, blocks, numbers, access):
+        """ Yield each of the block numbers in order, with a mapping of the
+        file holding it and where the block starts in there """
+        size = runs * self.VALUE.size
+        end = self._block(runs, blocks)
+        mapping, start = None, 0
+        try:
+            for n in sorted(numbers):
+                offset = self._block(runs, n)
+                if mapping is None or offset + size > start + len(mapping):
+                    if mapping is not None:
+                        mapping.close()
+                    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                    mapping = mmap.mmap(fd, min(end, max(offset + size,
+                        start + self.CHUNK)) - start, access=access,
+                        offset=start)
+                yield n, mapping, offset - start
         finally:
-            cls.sedinfo = json.loads(output)
-        # This should only ever fail if the system is not registered, in which 
-        # case most of this is moot anyway.
-        output = subprocess.check_output(
-            ["/usr/racktop/sbin/bsradm", "-j", "smb"])
-        cls.smbiosinfo = json.loads(output)
+            if mapping is not None:
+                mapping.close()
+
+    def append(self, samples, when=None, every=0):
+        """ Append (name, value) samples taken at when, now by default, as a
+        run. Return whether it was appended, which it is not when the last
+        run was less than `every` seconds before. """
+        when = time.time() if when is None else when
+        with self._opened() as (fd, runs, appended, times, index):
+            keys, firsts, lasts = index
+            run = appended
+            if run and when - times[(run - 1) % runs] < every:
+                return False
+            blocks = dict((key, n) for n, key in enumerate(keys)
+                if firsts[n] <= lasts[n])
+            # Values by block, and those of series without one yet by key.
+            written, new = {}, {}
+            for name, value in samples:
+                key = self.key(name)
+                if key in blocks:
+                    written[blocks[key]] = value
+                else:
+                    new[key] = value
+            del blocks
+            free = [n for n in range(len(keys)) if n not in written and
+                (firsts[n] > lasts[n] or run - lasts[n] >= runs)]
+            grown = max(0, len(new) - len(free))
+            if grown:
+                # The index moves past the new blocks before they are written,
+                # which overlap where it was.
+                free.extend(range(len(keys), len(keys) + grown))
+                keys.extend([0] * grown)
+                firsts.extend([1] * grown)
+                lasts.extend([0] * grown)
+                os.ftruncate(fd, self._block(runs, len(keys)) +
+                    len(keys) * self.INDEX)
+                self._write_index(fd, runs, index)
+                self._write(fd, 0, self.HEADER.pack(self.MAGIC, runs,
+                    len(keys), appended))
+            for key, value in new.items():
+                n = free.pop()
+                keys[n], firsts[n], lasts[n] = key, 1, 0
+                written[n] = value
+            del new, free
+            for n, mapping, base in self._mapped(fd, runs, len(keys),
+                written, mmap.ACCESS_WRITE):
+                first, last = firsts[n], lasts[n]
+                if first > last or run - last >= runs:
+                    first = run
+                elif last < run - 1:
+                    # Carry the last value over the runs the series missed.
+                    at = base + self._slot(runs, last)
+                    missed = mapping[at:at + self.VALUE.size]
+                    for gap in range(last + 1, run):
+                        at = base + self._slot(runs, gap)
+                        mapping[at:at + self.VALUE.size] = missed
+                at = base + self._slot(runs, run)
+                mapping[at:at + self.VALUE.size] = self.VALUE.pack(written[n])
+                firsts[n], lasts[n] = first, run
+            self._write(fd, self.HEADER.size + self._slot(runs, run),
+                self.VALUE.pack(when))
+            self._write_index(fd, runs, index)
+            self._write(fd, 0, self.HEADER.pack(self.MAGIC, runs,
+                len(keys), run + 1))
+        return True
+
+    def read(self, names, since, lowest=()):
+        """ Return the first value since a time of each named series which
+        has any, with the lowest value since then of those in `lowest` and
+        None for the others, whose other values are not read """
+        wanted = dict((self.key(name), name) for name in names)
+        lowest = set(lowest)
+        window = {}
+        with self._opened() as (fd, runs, appended, times, index):
+            keys, firsts, lasts = index
+            # Runs are in time order, find the first one in the window.
+            lo, hi = max(0, appended - runs), appended
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if times[mid % runs] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            spans = {}
+            for n, key in enumerate(keys):
+                if key in wanted and max(lo, firsts[n]) <= lasts[n]:
+                    spans[n] = (wanted[key], max(lo, firsts[n]), lasts[n])
+            for n, mapping, base in self._mapped(fd, runs, len(keys),
+                spans, mmap.ACCESS_READ):
+                name, first, last = spans[n]
+                start = base + self._slot(runs, first)
+                value = self.VALUE.unpack_from(mapping, start)[0]
+                low = None
+                if name in lowest:
+                    end = base + self._slot(runs, last) + self.VALUE.size
+                    if start < end:
+                        values = self._array(mapping[start:end])
+                    else:
+                        values = self._array(mapping[start:base + runs *
+                            self.VALUE.size] + mapping[base:end])
+                    low = min(values)
+                window[name] = (value, low)
+        return window
+
+class Trends(object):
+    """ The current value of each series, along with the first of its earlier
+    values within the history window, and the lowest of them for series
+    whose rise is asked for """
+    def __init__(self, current, window):
+        self.current = current
+        self.window = window
+
+    def names(self, prefix):
+        return sorted(name for name in self.current if name.startswith(prefix))
+
+    def delta(self, name):
+        """ How much a series changed over the window """
+        value = self.current[name]
+        return value - self.window.get(name, (value, value))[0]
+
+    def rise(self, name):
+        """ How far a series is above its lowest value in the window """
+        value = self.current[name]
+        return value - min(self.window.get(name, (value, value))[1], value)
+
+def _history_samples(store):
+    samples = []
+    if store.collect('drives') is None:
+        for drive in store.get('drives'):
+            if not drive.serial:
+                continue
+            if drive.hwadm is not None and \
+                drive.hwadm.temperature is not None:
+                samples.append(("temperature:%s" % drive.serial,
+                    drive.hwadm.temperature))
+            for stat in SDERR_COUNTERS:
+                value = (drive.sderr or {}).get(stat)
+                if isinstance(value, (int, long)):
+                    samples.append(("sderr:%s:%s" % (drive.serial, stat),
+                        value))
+    if store.collect('ipmi_sdr') is None:
+        for sensor in store.get('ipmi_sdr').get(u'IPMISDRDUMP') or ():
+            if isinstance(sensor.get(u'Value'), (int, long, float)):
+                samples.append(("sensor:%s" % sensor[u'Name'],
+                    sensor[u'Value']))
+    return [(name.encode("utf-8"), sample) for name, sample in samples]
+
+def _record_history(store):
+    # Read the window before adding this run, then add it unless the last
+    # run added is too recent. A store replaying another system's data has
+    # no history of that system.
+    samples = _history_samples(store)
+    window = {}
+    if store.keeps_state:
+        now = time.time()
+        history = History(os.path.join(STATE_DIR, "history.ring"))
+        # Error counters are only compared with their first value.
+        window = history.read([name for name, _ in samples],
+            now - HISTORY_WINDOW, lowest=[name for name, _ in samples
+            if not name.startswith(b"sderr:")])
+        history.append(samples, now, every=HISTORY_INTERVAL * 0.9)
+    return Trends(dict(samples), window)
+
+FACTS = dict((f.name, f) for f in [
+    Fact('hwadm', ["/usr/racktop/sbin/hwadm", "-j", "ls", "a"],
+        parse=_parse_hwadm,
+        error="something unexpected happened with hwd!",
+        hints={1: "hwd service is probably no running, " \
+            "check with: 'svcs hwd'"}, refresh=300),
+    Fact('secadm', ["/usr/racktop/sbin/secadm", "-j", "ls", "a"],
+        error="something unexpected happened with secured!",
+        hints={1: "secured service is probably no running, " \
+            "check with: 'svcs secured'"}, refresh=300),
+    # This should only ever fail if the system is not registered, in which
+    # case most of this is moot anyway.
+    Fact('smbios', ["/usr/racktop/sbin/bsradm", "-j", "smb"],
+        error="unable to read SMBIOS data, system is probably " \
+            "not registered", refresh=3600),
+    Fact('kernel_msgs', collect=_scan_kernel_log, refresh=30,
+        paths=(KERNEL_LOG,)),
+    Fact('cores', collect=_list_cores, refresh=30, paths=("/var/cores",)),
+    # ipmitool carries on with the next query when one fails.
+    Fact('ipmi', ["/usr/bin/ipmitool", "exec", "/dev/stdin"],
+        input=IPMI_BATCH, parse=_split_ipmi_batch, check=False, lock="bmc",
+        refresh=120, cache=60),
+    Fact('ipmi_chassis', collect=_ipmi_answer("chassis",
+        _parse_chassis_status), needs=('ipmi',), refresh=120),
+    Fact('ipmi_root_user', collect=_ipmi_answer("user", _parse_line),
+        needs=('ipmi',), refresh=120),
+    Fact('ipmi_sdr', collect=_ipmi_answer("sdr", json.loads),
+        needs=('ipmi',), refresh=120),
+    # The config table of zpool status is display text meant for people,
+    # parsed by how deep each row is indented. It is read nonetheless as
+    # zpool list -H -v, the output meant for scripts, prints every vdev below
+    # a pool after a single tab whatever its depth, losing which mirror or
+    # raidz each device belongs to. zpool status exits non-zero when there
+    # are no pools, reported as none.
+    Fact('zpools', ["/usr/sbin/zpool", "status"], parse=_parse_zpool_status,
+        check=False, refresh=300),
+    # zfs exits non-zero when some of the datasets do not exist, but still
+    # reports the ones which do.
+    Fact('zfs_properties', ["/usr/sbin/zfs", "get", "-H", "-p",
+        ",".join(_unique(prop for _, prop, _ in DATASET_PROPERTIES))] +
+        _unique(dataset for dataset, _, _ in DATASET_PROPERTIES),
+        parse=_parse_zfs_get, check=False, refresh=3600),
+    Fact('smf_explain', ["/usr/bin/svcs", "-xv"], parse=None),
+    # svcs exits non-zero when some of the services do not exist, but still
+    # reports the ones which do.
+    Fact('smf_states', ["/usr/bin/svcs", "-H", "-o", "state,fmri"] +
+        [service for service, _, _ in SMF_SERVICES], parse=_parse_smf_states,
+        check=False),
+    Fact('license', ["/usr/racktop/sbin/myrackadm", "-j", "lic", "show"],
+        refresh=3600, cache=3600),
+    Fact('domain', ["/usr/racktop/sbin/bsradm", "-j", "dns", "domain", "get"],
+        refresh=3600),
+    Fact('os_installed', ["/usr/racktop/sbin/bsradm", "-j", "os", "installed"],
+        refresh=3600, cache=3600),
+    Fact('os', ["/usr/racktop/sbin/bsradm", "-j", "os"], refresh=3600),
+    Fact('fma_faulty', ["/usr/sbin/fmadm", "faulty", "-s"], parse=None),
+    # Only the first few error events are read, the check fails on any.
+    Fact('fmdump', ["/usr/sbin/fmdump", "-e", "-t30day"], parse=None,
+        timeout=5, partial=True, refresh=300, cache=900,
+        lines=FMDUMP_EVENTS + 1),
+    Fact('sderr', ["/usr/bin/kstat", "-j", "-p", "sderr:::"],
+        parse=_parse_sderr),
+    Fact('drives', collect=_drive_inventory,
+        needs=('hwadm', 'secadm', 'sderr')),
+    Fact('history', collect=_record_history, needs=('drives', 'ipmi_sdr'),
+        refresh=HISTORY_INTERVAL),
+])
+
+def evaluate_rules(rules, columns):
+    """ Evaluate a table of rules over columns of data, returning the
+    failure matrix: for each row, the messages of the rules it breaks.
+
+    Columns map names to lists of values, the nth value of each being row n.
+    Each rule is a (columns, predicate, message) triple, the predicate taking
+    the values of the rule's columns in a row. It is applied to the whole of
+    its columns at once. Rows for which it is false, or raises, fail it. The
+    message is formatted with the row's values by column name.
+    """
+    rows = max([len(values) for values in columns.values()] or [0])
+    matrix = [[] for _ in range(rows)]
+    for names, predicate, message in rules:
+        for row, values in enumerate(zip(*[columns[name] for name in names])):
+            try:
+                ok = predicate(*values)
+            except Exception:
+                ok = False
+            if not ok:
+                matrix[row].append(message % dict(zip(names, values)))
+    return matrix
+
+def columns_of(records, names):
+    """ Return columns of attributes of records, or of keys of dicts """
+    get = (lambda record, name: record.get(name)) if records and \
+        isinstance(records[0], dict) else getattr
+    return dict((name, [get(record, name) for record in records])
+        for name in names)
+
+# Bays of each model of shelf, zero for heads without any.
+SHELF_BAYS = {
+    u'H4060-J': 60,
+    u'SP-3424-E12EBD': 24,
+    u'SBX24LC-ECEBD': 24,
+    u'GXY124S2V': 0,
+    u'GXY108S2V': 0,
+}
+
+KNOWN_DRIVE_VENDORS = ("hgst", "hitachi", "seagate")
+
+# Drives whose make contains any of these are not checked, they are not
+# expected to be used for pools.
+SKIPPED_DRIVE_MAKES = ("ata",)
+
+def _registered_recently(status, timestamp):
+    # Nothing should be registered before 2017, more than about a year ago,
+    # or later than now.
+    if status != u"Registered":
+        return True
+    registered = datetime.datetime.strptime(timestamp[:-5],
+        "%Y-%m-%dT%H:%M:%S")
+    now = datetime.datetime.now()
+    return registered.year >= 2017 and now.year - registered.year <= 1 and \
+        registered < now
+
+def _rpm_expected(kind, rpm):
+    # Mechanical drives spin at 7200 RPM, solid state ones not at all.
+    return {"hdd": 7200, "ssd": 0}.get(kind.lower(), rpm) == rpm
+
+# Rules every drive reported by hwadm must follow, as (attributes, predicate,
+# message), see evaluate_rules and Drive.
+DRIVE_RULES = (
+    (("make",), lambda make: make.lower() in KNOWN_DRIVE_VENDORS,
+        "make '%(make)s' is unexpected"),
+    (("registration",), lambda status: status != u"NotSupported",
+        "registration is not supported"),
+    (("registration", "registered"), _registered_recently,
+        "registered at %(registered)s, expected since 2017, within the " \
+        "last year and not in the future"),
+    (("path", "device"), lambda path, device:
+        path == "/dev/rdsk/%ss0" % device,
+        "path '%(path)s' is not that of its device"),
+    (("serial",), lambda serial: len(serial) >= 8,
+        "serial '%(serial)s' is shorter than 8 characters"),
+    (("model",), bool, "model is empty"),
+    (("unit_id",), lambda unit_id: len(unit_id) == 16,
+        "storage unit ID '%(unit_id)s' is not 16 characters long"),
+    (("wwn",), lambda wwn: len(wwn) == 16,
+        "WWN '%(wwn)s' is not 16 characters long"),
+    # The largest shelf has 84 bays.
+    (("bay",), lambda bay: 0 <= bay <= 83,
+        "bay number %(bay)s is not between 0 and 83"),
+    (("temperature",), lambda temperature: temperature >= 0,
+        "temperature %(temperature)sC is negative"),
+    (("max_temperature",), lambda maximum: maximum >= 0,
+        "maximum operating temperature %(max_temperature)sC is negative"),
+    (("temperature", "max_temperature"), lambda temperature, maximum:
+        temperature <= maximum, "temperature %(temperature)sC is above " \
+        "the maximum operating temperature of %(max_temperature)sC"),
+    (("type",), lambda kind: kind.lower() in ("ssd", "hdd"),
+        "type '%(type)s' is neither SSD nor HDD"),
+    (("power_on",), lambda power_on: power_on > 0,
+        "power-on duration %(power_on)s is not positive"),
+    (("type", "rpm"), _rpm_expected,
+        "%(type)s spins at %(rpm)s RPM, expected 7200 for HDDs and 0 for SSDs"),
+    (("capacity",), lambda capacity: capacity > 100 << 30,
+        "capacity of %(capacity)s bytes is not above 100 gigabytes"),
+)
+
+# Rules for the units reported by hwadm, with their number of bays.
+UNIT_RULES = (
+    (("part_number", "bay_count"), lambda model, count:
+        SHELF_BAYS.get(model) == count,
+        "%(part_number)s has an unexpected %(bay_count)s bays"),
+)
+
+# Rules for the drive bays of every unit, with the index of each bay.
+BAY_RULES = (
+    (("status",), lambda status: status in (u'OK', u'NotInstalled'),
+        "status is '%(status)s' instead of 'OK' or 'NotInstalled'"),
+    (("problems",), lambda problems: problems is None,
+        "has problems '%(problems)s'"),
+    (("fault_led",), lambda led: not led, "fault light is on"),
+    (("identify_led",), lambda led: not led, "identify light is on"),
+    (("index", "number"), lambda index, number: index == number,
+        "is numbered %(number)s"),
+)
+
+# Rules for the SED state secadm reports of drives outside bp. Drives which
+# do not support SED cannot be rekeyed, unlocked and so on.
+SED_RULES = (
+    (("Serial",), bool, "serial is empty"),
+    (("AutoUnlock",), lambda unlock: not unlock, "AutoUnlock is set"),
+    (("Rekeying",), lambda rekeying: not rekeying, "is rekeying"),
+    (("Status", "Refreshing"), lambda status, refreshing:
+        status != u'NotSupported' or not refreshing,
+        "is refreshing without SED support"),
+    (("Status", "LastActionPending"), lambda status, pending:
+        status != u'NotSupported' or not pending,
+        "has an action pending without SED support"),
+    (("Status",), lambda status: status in (u'NotSupported', u'NotEnrolled'),
+        "status is '%(Status)s' instead of 'NotEnrolled'"),
+    (("Status", "ReadyStatus"), lambda status, ready:
+        status == u'NotSupported' or ready == u'Ready',
+        "ReadyStatus is '%(ReadyStatus)s' instead of 'Ready'"),
+    (("Status", "Problems"), lambda status, problems:
+        status == u'NotSupported' or problems is None,
+        "has problems '%(Problems)s'"),
+)
+
+class BasicSystemSanity(unittest.TestCase):
+    # Facts collected for the current run, shared by every check.
+    facts = FactStore()
+
+    def iam_virtual(self):
+        return self.smbiosinfo[u'IsVm']
 
+    def drive_is_from_bp(self, serial):
+        return self.inventory.in_pool(serial)
+
+    def assertRulesHold(self, what, labels, matrix):
+        """ Fail listing every row of a failure matrix which broke a rule """
+        broken = ["%s %s" % (label, ", ".join(failures))
+            for label, failures in zip(labels, matrix) if failures]
+        self.assertEqual(broken, [],
+            "Expected every %s to be as expected, instead %d are not: %s" % (
+            what, len(broken), "; ".join(broken)))
+
+    def drive_label(self, name, serial):
+        serial = serial.strip()
+        return "%s (serial %s)" % (name, serial) if serial else name
+
+    def assertNoSderrErrors(self, stat):
+        """ Fail naming each drive whose sderr `stat` counter is nonzero """
+        errct = 0
+        offenders = []
+        for drive, data in self.facts.get('sderr').items():
+            if data[stat] != 0:
+                errct += data[stat]
+                record = self.inventory.by_instance[drive]
+                label = self.drive_label(drive, record.serial)
+                if record.bay is not None:
+                    label += " in bay %d" % record.bay
+                    if record.enclosure is not None:
+                        label += " of enclosure %s" % record.enclosure
+                offenders.append("%s has '%d'" % (label, data[stat]))
+        self.assertEqual(errct, 0,
+            "Expected to get 0 errors, instead have '%d' errors: %s" % (
+            errct, ", ".join(offenders)))
+
+    def assertServiceState(self, service, state):
+        states = [(fmri, actual)
+            for fmri, actual in self.facts.get('smf_states')
+            if smf_fmri_matches(service, fmri)]
+        self.assertTrue(states,
+            "Expected %s to be '%s', service is not present" % (
+            service, state))
+        for fmri, actual in states:
+            self.assertEqual(actual, state,
+                "Expected %s to be '%s', got '%s'" % (fmri, state, actual))
+
+    @property
+    def hwinfo_drives(self):
+        return self.facts.get('hwadm').drives
+
+    @property
+    def hwinfo_units(self):
+        return self.facts.get('hwadm').units
+
+    @property
+    def sedinfo(self):
+        return self.facts.get('secadm')
+
+    @property
+    def smbiosinfo(self):
+        return self.facts.get('smbios')
+
+    @property
+    def inventory(self):
+        return self.facts.get('drives')
+
+    @classmethod
+    def collect_source(cls, name):
+        """ Collect a fact, returning None or the reason it is unavailable """
+        return cls.facts.collect(name)
 
     @classmethod
     def tearDownClass(cls):
         pass # We don't need this for the time being
 
     def setUp(self):
-        pass # We don't need this for the time being
+        started = time.time()
+        try:
+            for name in check_sources(self):
+                error = self.collect_source(name)
+                if error is not None and self.facts.timed_out(name):
+                    self.facts.get(name) # Report the timeout itself
+                if error is not None and \
+                    self.facts.facts[name].skip_unavailable:
+                    self.skipTest("'%s' data is unavailable" % name)
+        finally:
+            self._set_up = time.time()
+            if PROFILER is not None:
+                PROFILER.check(self._testMethodName,
+                    wait=self._set_up - started)
 
     def tearDown(self):
-        pass # We don't need this for the time being
+        if PROFILER is not None:
+            PROFILER.check(self._testMethodName,
+                **{"assert": time.time() - self._set_up})
 
     def shortDescription(self):
         doc = self._testMethodDoc
         return doc and doc or None
 
+    @tags('logs')
+    @uses('kernel_msgs')
     def test_system_log_no_kernel_msgs(self):
         """ System log does not contain any kernel warnings or errors """
-        output = self.exec_with_timeout(
-            ["egrep", 'kern.warn|kern.err',"/var/adm/messages"], 5)
-        lines_count = 0
-        handle = cStringIO.StringIO(output)
-        while True:
-            line = handle.readline()
-            if line == '':
-                break
-            if 'ddrx104' in line: # Hack, ddrdrive false positive
-                continue
-            else:
-                lines_count+=1
+        counts = self.facts.get('kernel_msgs')
+        lines_count = sum(counts.values())
         self.assertEqual(lines_count, 0,
             "Expected no output, instead log contains '%d' " \
-            "kernel warnings and/or errors" % lines_count)
+            "kernel warnings and/or errors (%s)" % (lines_count,
+            ", ".join("%s: %d" % item for item in counts.items())))
 
+    @tags('ipmi')
+    @uses('smbios', 'ipmi_chassis')
     def test_head_chassis_status_expected(self):
         """ Check that controller chassis status is acceptable """
         if self.iam_virtual():
@@ -228,12 +2076,7 @@ class BasicSystemSanity(unittest.TestCase):
             'DriveFault': 'false',
             'PowerRestorePolicy': 'previous'
         }
-        output = subprocess.check_output(
-            ["/usr/bin/ipmitool", "chassis", "status"]
-        )
-        split = lambda s: [tuple(w.replace(' ', '').split(':')) 
-            for w in s.rstrip('\n').split('\n')]
-        pairs = split(output.rstrip('\n'))
+        pairs = self.facts.get('ipmi_chassis')
         # Walk each value from the output of command and compare it to expected
         # values saved in dict `d`, this may not be entirely correct.
         for key, value in pairs:
@@ -241,108 +2084,104 @@ class BasicSystemSanity(unittest.TestCase):
                 self.assertEqual(value, d[key],
                 "Expected value is '%s', actual is '%s" % (d[key], value))
 
+    @tags('enclosures')
+    @uses('smbios', 'hwadm')
     def test_hwadm_shelf_sensors_expected(self):
         """ Check that all sensors in enclosure are in expected state """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
 
         for unit in self.hwinfo_units:
-            for sensor in unit[u'Sensors']:
-                self.assertIn(sensor[u'Status'], [u'OK', u'NotInstalled'],
+            for sensor in unit.sensors:
+                self.assertIn(sensor.status, [u'OK', u'NotInstalled'],
                     "Expected value is 'OK' or 'NotInserted', actual value " \
-                    "of '%s' sensor is '%s'" % (
-                        sensor[u'Name'], sensor[u'Status'])
+                    "of '%s' sensor is '%s'" % (sensor.name, sensor.status)
                 )
 
+    @tags('enclosures')
+    @uses('smbios', 'hwadm')
     def test_hwdadm_head_unit_exists_expected(self):
         """ Exactly one head unit must be present """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
         head_count = 0
         for unit in self.hwinfo_units:
-            if unit[u'IsHeadUnit']:
+            if unit.is_head:
                 head_count +=1 
 
         self.assertEqual(head_count, 1,
         "Expected '1' head units, got '%d'" % head_count)
 
+    @tags('enclosures')
+    @uses('smbios', 'hwadm')
     def test_enclusures_multipathed_expected(self):
         """ Check that more than a single SAS path is connected """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
         for unit in self.hwinfo_units:
-            if unit[u'IsHeadUnit']:
+            if unit.is_head:
                 continue
-            self.assertTrue(len(unit[u'Paths']) > 1,
+            self.assertTrue(len(unit.paths) > 1,
             "Expected at least two paths connected to enclosure")
 
+    @tags('enclosures', 'drives')
+    @uses('smbios', 'hwadm')
     def test_hwadm_drive_bay_state_expected(self):
         """ Check that all bays in enclosures are in expected state """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
-        # print self.hwinfo_units
-        # If this is a head, instead of a list, u'DriveBays' object is 
-        # actually null, which does not play nice when you do len(None).
-        # To avoid this, we instead create a local length function, just for
-        # this method, which returns 0 in the None case, and len(d) otherwise
-        # for the u'DriveBays' dict.
-        llen = lambda d: 0 if d is None else len(d)
-        for unit in self.hwinfo_units:
-            self.assertTrue(
-                self.enclosure_bay_count_ok(
-                    unit[u'PartNumber'], llen(unit[u'DriveBays'])),
-                    "Got unexpected bay count for enclosure %s" % \
-                    unit[u'PartNumber'])
-            if unit[u'DriveBays'] != None:
-                for idx, bay in enumerate(unit[u'DriveBays']):
-                    self.assertIn(bay[u'Status'], [u'OK', u'NotInstalled'],
-                    "Expected value is 'OK' or 'NotInserted', actual value " \
-                    "of bay '%d' is '%s'" % (idx, bay[u'Status'])
-                    )
-                    self.assertIsNone(bay[u'Problems'],
-                    "Expected value is 'None', actual is '%s'" % bay[u'Problems'])
-                    self.assertFalse(bay[u'FaultLedOn'],
-                    "Expected Fault Light to be off")
-                    self.assertFalse(bay[u'IdentifyLedOn'],
-                    "Expected Identify Light to be off")
-                    self.assertEqual(idx, bay[u'BayNumber'],
-                    "Expected value is '%d', actual is '%d'" % \
-                    (idx, bay[u'BayNumber']))
-
+        units = self.hwinfo_units
+        # Heads have None instead of a list of bays.
+        columns = columns_of(units, ("part_number",))
+        columns["bay_count"] = [len(unit.bays or ()) for unit in units]
+        self.assertRulesHold("enclosure", [unit.part_number
+            for unit in units], evaluate_rules(UNIT_RULES, columns))
+        labels = []
+        bays = []
+        indexes = []
+        for unit in units:
+            for idx, bay in enumerate(unit.bays or ()):
+                labels.append("bay %d of %s" % (idx, unit.part_number))
+                bays.append(bay)
+                indexes.append(idx)
+        columns = columns_of(bays, Bay.__slots__)
+        columns["index"] = indexes
+        self.assertRulesHold("bay", labels, evaluate_rules(BAY_RULES, columns))
+
+    @tags('enclosures')
+    @uses('smbios', 'hwadm')
     def test_controller_psu_state_expected(self):
         """ Check that power supply state is acceptable """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
 
         psu_count = 0
-        for sensor in self.hwinfo_units[0][u'Sensors']:
-            if sensor[u'Name'] == u'PS1' or sensor[u'Name'] == u'PS2':
+        for sensor in self.hwinfo_units[0].sensors:
+            if sensor.name == u'PS1' or sensor.name == u'PS2':
                 psu_count += 1
-                self.assertEqual(sensor[u'Type'], "Power", "Expected value is 'Power', actual is '%s'" % sensor[u'Type'])
+                self.assertEqual(sensor.type, "Power", "Expected value is 'Power', actual is '%s'" % sensor.type)
 
         self.assertEqual(psu_count, 2,
             "Expected to observe '2' power supplies, instead have '%d'" % \
             psu_count)
 
+    @tags('ipmi')
+    @uses('smbios', 'ipmi_root_user')
     def test_bmc_has_root_acct_expected(self):
         """ Check that BMC has root account created """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
-        output = subprocess.check_output(
-            ["/usr/bin/ipmitool", "user", "test", "2", "16",
-                base64.b64decode(b'cmFja3RvcA==')]
-        )
-        self.assertEqual(output.rstrip('\n'), "Success",
+        output = self.facts.get('ipmi_root_user')
+        self.assertEqual(output, "Success",
         "Expected value is 'Success', actual is '%s'" % output)
 
+    @tags('ipmi')
+    @uses('smbios', 'ipmi_sdr')
     def test_head_hw_state_expected(self):
         """ Check that sensor readings in controller are acceptable """
         if self.iam_virtual():
             self.skipTest(ERR_NOT_POSSIBLE)
-        output = subprocess.check_output(
-            ["/usr/bin/ipmitool", "sdr", "jlist"]
-        )
-        j = json.loads(output)
+        j = self.facts.get('ipmi_sdr')
         for item in j[u'IPMISDRDUMP']:
             if u'Health' in item.keys():
                 # Some sensors will report `ns => not specified`, which we
@@ -350,6 +2189,8 @@ class BasicSystemSanity(unittest.TestCase):
                 self.assertIn(item[u'Health'], [u'ok', u'ns'],
                 "Expected value is 'ok', actual is '%s'" % item[u'Health'])
 
+    @tags('platform')
+    @uses('smbios')
     def test_platform_info_expected(self):
         """ Check that platform information is correctly set """
         j = self.smbiosinfo
@@ -379,361 +2220,252 @@ class BasicSystemSanity(unittest.TestCase):
         self.assertTrue(j[u'SystemSerial'] != "",
             "Expected system serial number to not be empty")
 
+    @tags('zfs')
+    @uses('zpools')
     def test_bp_is_mirrored(self):
         """ System pool 'bp' must be a 2-way mirror """
-        p = subprocess.Popen(
-            ['/usr/sbin/zpool', 'status', 'bp'], stdout=PIPE)
-        output = p.communicate()
-        self.assertEqual(
-            len([line for line in output[0].split('\n') 
-                if line.find('mirror') > 0]), 1, "Expected bp to be mirrored")
-
+        bp = self.facts.get('zpools').get('bp')
+        self.assertIsNotNone(bp, "Expected to find pool bp")
+        mirrors = [vdev for vdev in bp.children
+            if vdev.name.startswith('mirror')]
+        self.assertEqual(len(mirrors), 1, "Expected bp to be mirrored")
+        self.assertEqual(len(mirrors[0].children), 2,
+            "Expected bp to be a 2-way mirror, instead have '%d' devices" \
+            % len(mirrors[0].children))
+
+    @tags('zfs')
+    @uses('zfs_properties')
     def test_profiles_expected(self):
         """ Check that correct profiles are set on core OS filesystems """
-        output = subprocess.check_output(["/usr/sbin/zfs", "get", "-H", "-o", 
-            "value", "racktop:storage_profile", "bp/etc"])
-        self.assertEqual(output.rstrip('\n'), "sysconfig_filesystem",
-            "Expected to get 'sysconfig_filesystem', got '%s'" \
-            % output.rstrip('\n'))
-        output = subprocess.check_output(["/usr/sbin/zfs", "get", "-H", "-o", 
-            "value", "racktop:storage_profile", "bp/var"])
-        self.assertEqual(output.rstrip('\n'), "system",
-            "Expected to get 'system', got '%s'" \
-            % output.rstrip('\n'))
-
+        values = self.facts.get('zfs_properties')
+        wrong = ["%s of %s is '%s' instead of '%s'" % (prop, dataset,
+            values.get((dataset, prop), "missing"), expected)
+            for dataset, prop, expected in DATASET_PROPERTIES
+            if values.get((dataset, prop)) != expected]
+        self.assertEqual(wrong, [],
+            "Expected dataset properties to be set, instead %s" \
+            % ", ".join(wrong))
+
+    @tags('smf')
+    @uses('smf_explain')
     def test_smf_is_healthy(self):
         """ SMF should not report anything if all services are online """
-        output = subprocess.check_output(["/usr/bin/svcs", "-xv"])
+        output = self.facts.get('smf_explain')
         self.assertEqual(output, "",
             "Expected no output, instead one or more services is not healthy")
 
-    def test_bsrlicensed_is_online(self):
-        """ bsrlicensed service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "bsrlicensed"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected bsrlicensed to be 'online', " \
-            "got '%s'" % output.rstrip('\n'))
-
-    def test_bsrinit_is_online(self):
-        """ bsrinit service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "bsrinit"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected bsrinit to be 'online', " \
-            "got '%s'" % output.rstrip('\n'))
-
-    def test_hwd_is_online(self):
-        """ hwd service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "hwd"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected hwd to be 'online', got '%s'" % output.rstrip('\n'))
-
-    def test_secured_is_online(self):
-        """ secured service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "secured"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected secured to be 'online', " \
-            "got '%s'" % output.rstrip('\n'))
-
-    def test_dataprotectiond_is_online(self):
-        """ dataprotectiond service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "dataprotectiond"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected dataprotectiond to be 'online', " \
-            "got '%s'" % output.rstrip('\n'))
-
-    def test_datareplicationd_is_disabled(self):
-        """ datareplicationd service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "datareplicationd"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected datareplicationd to be 'online', " \
-            "got '%s'" % output.rstrip('\n'))
-
-    def test_bsrapid_is_online(self):
-        """ bsrapid service must always be online """
-        output = subprocess.check_output(
-            ["/usr/bin/svcs", "-H", "-o", "state", "bsrapid"])
-        self.assertEqual(output.rstrip('\n'), "online",
-            "Expected bsrapid to be 'online', got '%s'" % output.rstrip('\n'))
-
+    @tags('logs')
+    @uses('cores')
     def test_no_core_files_present(self):
         """ Check that there are no core files present """
-        _, _, filenames = os.walk("/var/cores").next()
+        filenames = self.facts.get('cores')
         self.assertListEqual(filenames, [],
             "Expected to find no core files, instead found '%d' files" \
             % len(filenames))
 
+    @tags('platform')
+    @uses('license')
     def test_license_installed_expected(self):
         """ Confirm host license is present """
-        output = subprocess.check_output(
-            ["/usr/racktop/sbin/myrackadm", "-j", "lic", "show"]
-        )
-        j = json.loads(output.rstrip('\n'))
+        j = self.facts.get('license')
         self.assertNotEqual(j[u'Host'],
             "0000-0000-0000-0000-00000-0000-00000-0000-00000")
 
+    @tags('platform')
+    @uses('domain')
     def test_domain_name_present(self):
         """ Machine should have some value for domain name """
-        output = subprocess.check_output(
-            ["/usr/racktop/sbin/bsradm", "-j", "dns", "domain", "get"]
-        )
-        j = json.loads(output.rstrip('\n'))
+        j = self.facts.get('domain')
         self.assertTrue(j[u'result'] != "")
 
+    @tags('platform')
+    @uses('os_installed')
     def test_only_one_image_installed(self):
         """ Only a single OS image should be loaded """
-        output = subprocess.check_output(
-            ["/usr/racktop/sbin/bsradm", "-j", "os", "installed"])
-        j = json.loads(output.rstrip('\n'))
+        j = self.facts.get('os_installed')
         self.assertEqual(len(j), 1,
             "Expected to find only a single OS image, " \
             "instead found '%d' images" % len(j))
 
+    @tags('platform')
+    @uses('os')
     def test_os_version_expected(self):
         """ Check that correct version of OS is loaded """
-        output = subprocess.check_output(
-            ["/usr/racktop/sbin/bsradm", "-j", "os"]
-        )
-        j = json.loads(output)
+        j = self.facts.get('os')
         self.assertEqual(j[u'BootGuid'], os_guid)
 
+    @tags('fma')
+    @uses('fma_faulty')
     def test_fault_state_expected(self):
         """ Check that Fault Management did not detect any faults """
-        output = subprocess.check_output(
-            ["/usr/sbin/fmadm", "faulty", "-s"]
-        )
+        output = self.facts.get('fma_faulty')
         self.assertEqual(output.rstrip('\n'), "",
         "Expected to get no results, instead have '%d' faults" \
         % len(output.split('\n')[3:-1]))
 
+    @tags('fma')
+    @uses('fmdump')
     def test_no_fmdump_entries_expected(self):
         """ Fault management debug log should be empty """
-        output = self.exec_with_timeout(
-            ["/usr/sbin/fmdump", "-e", "-t30day"], 5)
+        output = self.facts.get('fmdump')
 
         # We should have a total of 1 lines with header
-        self.assertEqual(len(output.rstrip('\n').split('\n')[1:]), 0,
-        "Expected to find no results, instead have '%d' errors" \
-        % len(output.split('\n')[1:]))
+        events = output.rstrip('\n').split('\n')[1:]
+        self.assertEqual(len(events), 0,
+        "Expected to find no results, instead have %s'%d' errors" \
+        % ("at least " if len(events) >= FMDUMP_EVENTS else "", len(events)))
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_device_not_ready_errors_expected(self):
         """ Check that no drives report Device Not Ready """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::Device\ Not\ Ready"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'Device Not Ready']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'Device Not Ready')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_hard_errors_expected(self):
         """ Check that no drives report Hard Errors """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::Hard\ Errors"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'Hard Errors']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'Hard Errors')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_media_errors_expected(self):
         """ Check that no drives report Media Errors """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::Media\ Error"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'Media Error']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'Media Error')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_no_device_errors_expected(self):
         """ Check that no drives report No Device """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::No\ Device"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'No Device']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'No Device')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_soft_errors_expected(self):
         """ Check that no drives report Soft Errors """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::Soft\ Errors"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'Soft Errors']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'Soft Errors')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_no_transport_errors_expected(self):
         """ Check that no drives report Transport Errors """
-        errct = 0
-        output = subprocess.check_output(
-            ["/usr/bin/kstat", "-j", "-p", "sderr:::Transport\ Errors"]
-        )
-        j = json.loads(output)
-        for entry in j:
-            errct += entry[u'data'][u'Transport Errors']
-        self.assertEqual(errct, 0,
-        "Expected to get 0 errors, instead have '%d' errors" % errct)
+        self.assertNoSderrErrors(u'Transport Errors')
 
+    @tags('drives')
+    @uses('sderr', 'drives')
     def test_hwdadm_problem_counters_expected(self):
         """ Check that trouble counters on drives are at zero """
-        counters = (
-            u"SoftErrors",
-            u"HardErrors",
-            u"TransportErrors",
-            u"MediaError",
-            u"DeviceNotReady",
-            u"NoDevice",
-            u"Recoverable",
-            u"IllegalRequest",
-            u"PredictiveFailureAnalysis"
-        )
-        for i in self.hwinfo_drives:
-            for counter in counters:
-                self.assertEqual(i[u'OSInfo'][counter], 0,
-                "Expected to get 0 count, instead %s == '%d'" \
-                % (counter, i[u'OSInfo'][counter]))
-
+        # hwadm reports the same counters as the sderr kstats, read from
+        # the table shared with the checks on each of them.
+        offenders = []
+        for drive in self.inventory:
+            data = drive.sderr or {}
+            nonzero = ["%s == '%s'" % (counter, data[counter])
+                for counter in SDERR_COUNTERS if data.get(counter, 0) != 0]
+            if nonzero:
+                offenders.append("%s: %s" % (self.drive_label(
+                    drive.device or drive.instance, drive.serial),
+                    ", ".join(nonzero)))
+        self.assertEqual(offenders, [],
+            "Expected to get 0 count, instead %s" % "; ".join(offenders))
+
+    @tags('drives')
+    @uses('hwadm')
     def test_hwadm_drive_attributes_expected(self):
         """ Check drive count and basic attributes are acceptable """
-        now = datetime.datetime.now()
-        # Check that attributes of device make sense
         self.assertGreaterEqual(len(self.hwinfo_drives), 12,
             "Expected a minimum of '12' drives, have '%d'" % len(self.hwinfo_drives))
-        for i in self.hwinfo_drives:
-            if self.skip_drive_ok(i[u'Make']):
-                continue # Skip devices that we don't expect to be used for pool
-            self.assertTrue(self.known_drive_vendor(i[u'Make']),
-                "Encountered unexpected drive make: '%s'" % i[u'Make'])
-            ts = i[u'HWInfo'][u'RegistrationTimestamp'][:-5]
-            regts = datetime.datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S")
-            reg_stat = i[u'HWInfo'][u'RegistrationStatus']
-            ready_stat = i[u'HWInfo'][u'ReadyStatus']
-
-            # We will see how this works with SSDs
-            self.assertFalse(reg_stat == u"NotSupported",
-                "Registration should be supported on this drive")
-            if reg_stat == u"Registered":
-                # Nothing should be < 2017
-                self.assertGreaterEqual(regts.year, 2017)
-                # One years of sway
-                self.assertLessEqual(now.year - regts.year, 1)
-                # Registration timestamp cannot be later than time now
-                self.assertTrue(now > regts,
-                    "Registration timestamp cannot be more recent "\
-                    "than present time")
-
-            # Device name should be a part of a the device path.
-            self.assertEqual(i[u'Path'], "/dev/rdsk/%ss0" % i[u'DeviceName'])
-            # Model, Serial cannot be empty
-            self.assertIsNot(i[u'Serial'], "")
-            self.assertGreaterEqual(i[u'Serial'], 8)
-            self.assertIsNot(i[u'Model'], "")
-            # Some things have an expected length
-            self.assertEqual(len(i[u'StorageUnitId']), 16)
-            self.assertEqual(len(i[u'Wwn']), 16)
-            # Bay number should be a nonnegative value and 83 is largest
-            # possible currently, since largest shelf has 84 bays.
-            bay_min_idx, bay_max_idx = 0, 83
-            bay_idx = i[u'HWInfo'][u'Bay']
-            temp_c = i[u'HWInfo'][u'CelsiusTemperature']
-            temp_max_c = i[u'HWInfo'][u'MaxFunctionalTemp']
-            self.assertGreaterEqual(i[u'HWInfo'][u'Bay'], bay_min_idx,
-                "Bay number cannot be lower than '%d', " % bay_min_idx)
-            self.assertLessEqual(i[u'HWInfo'][u'Bay'], bay_max_idx,
-                "Bay number cannot be greater than '%d'" % bay_max_idx)
-            # Temperature sensors should be reporting something sensible
-            self.assertGreaterEqual(temp_c, 0,
-                "Temperature cannot be negative")
-            self.assertGreaterEqual(temp_max_c, 0,
-                "Maximum operating temperature cannot be negative")
-            # Current temp cannot be greater than maximum operating temp
-            self.assertLessEqual(temp_c, temp_max_c)
-            self.assertTrue(self.drive_type_sensible(i[u'HWInfo'][u'Type']),
-                "Only SSDs and HDDs are allowed drive types") 
-            # Drive power-on time must be non-negative, and not 0. 
-            self.assertGreater(i[u'HWInfo'][u'PowerOnDuration'], 0,
-                "Power-on duration must be a non-negative value > 0")
-            # Mechanical drives should report RPM value 7200
-            if self.drive_is_mechanical(i[u'HWInfo'][u'Type']):
-                self.assertEqual(i[u'HWInfo'][u'Rpm'], 7200,
-                "RPM value expected to be 7200, got '%d' instead" \
-                % i[u'HWInfo'][u'Rpm'])
-            elif self.drive_is_solid_state(i[u'HWInfo'][u'Type']):
-                self.assertEqual(i[u'HWInfo'][u'Rpm'], 0,
-                "RPM value expected to be 0 for SSDs, got '%d' instead" \
-                % i[u'HWInfo'][u'Rpm'])
-            # Drive capacity cannot be 0
-            self.assertGreater(i[u'OSInfo'][u'Capacity'], 100 << 30,
-                "Expected drive capacity to be greater than 100 gigabytes, " \
-                "got '%d' bytes instead" % i[u'OSInfo'][u'Capacity'])
-
+        # Skip devices that we don't expect to be used for pool
+        drives = [i for i in self.hwinfo_drives if not any(
+            make in (i.make or "").lower() for make in SKIPPED_DRIVE_MAKES)]
+        labels = []
+        for i in drives:
+            label = self.drive_label(i.device or "drive", i.serial or "")
+            if i.bay is not None:
+                label += " in bay %d" % i.bay
+            labels.append(label)
+        self.assertRulesHold("drive", labels, evaluate_rules(DRIVE_RULES,
+            columns_of(drives, Drive.__slots__)))
+
+    @tags('drives')
+    @uses('secadm', 'drives')
     def test_secadm_sed_state_expected(self):
         """ Check SED state of drives is acceptable """
-        for drive in self.sedinfo[u'Drives']:
-            self.assertTrue(drive[u'Serial'] != "",
-            "Expected Serial to not be an empty string, " \
-            "instead have empty string")
-            # Drives in bp pool will not be configured for SED, or compatible.
-            if self.drive_is_from_bp(drive[u'Serial']):
-                continue
-            # Several things need to be checked if drive is not supported.
-            # If not support it should not be possible to rekey, lock, etc.
-            if drive[u'Status'] == u'NotSupported':
-                for a, b in [
-                    (u'Rekeying', "Expected Rekeying to be set to False"),
-                    (u'AutoUnlock', "Expected AutoUnlock to be set to False"),
-                    (u'Refreshing', "Expected Refreshing to be set to False"),
-                    (u'LastActionPending',
-                        "Expected LastActionPending to be set to False"),
-                ]:
-                    self.assertFalse(drive[a], b)
-                continue
-
-            self.assertFalse(drive[u'AutoUnlock'],
-            "Expected AutoUnlock to be set to False on %s" \
-            % drive[u'Serial'])
-            self.assertFalse(drive[u'Rekeying'],
-            "Expected Rekeying to be set to False")
-            self.assertEqual(drive[u'ReadyStatus'], "Ready",
-            "Expected ReadyStatus to be set to True")
-            self.assertEqual(drive[u'Status'], "NotEnrolled",
-            "Expected Status to be set to 'Not Enrolled'")
-            self.assertEqual(drive[u'Problems'], None,
-            "Expected Problems to be 'null'")
-        pass
+        # Drives in bp pool will not be configured for SED, or compatible.
+        drives = [drive for drive in self.sedinfo[u'Drives']
+            if not self.drive_is_from_bp(drive[u'Serial'])]
+        names = set(name for rule in SED_RULES for name in rule[0])
+        self.assertRulesHold("SED drive",
+            [drive[u'Serial'] or "drive" for drive in drives],
+            evaluate_rules(SED_RULES, columns_of(drives, names)))
+
+    @tags('drives', 'history')
+    @uses('history')
+    def test_drive_error_counters_steady(self):
+        """ Check that no error counter of a drive rose within the window """
+        trends = self.facts.get('history')
+        risen = ["%s by %d" % (name.split(':', 1)[1], trends.delta(name))
+            for name in trends.names('sderr:')
+            if trends.delta(name) > 0]
+        self.assertEqual(risen, [],
+            "Expected error counters to stay put over the last %d hours, " \
+            "instead %s rose" % (HISTORY_WINDOW // 3600, ", ".join(risen)))
+
+    @tags('drives', 'history')
+    @uses('history')
+    def test_drive_temperature_steady(self):
+        """ Check that no drive warmed up much within the window """
+        trends = self.facts.get('history')
+        risen = ["%s by %dC" % (name.split(':', 1)[1], trends.rise(name))
+            for name in trends.names('temperature:')
+            if trends.rise(name) > TEMPERATURE_RISE]
+        self.assertEqual(risen, [],
+            "Expected drives to stay within %dC of their coolest over the " \
+            "last %d hours, instead %s warmed up" % (TEMPERATURE_RISE,
+            HISTORY_WINDOW // 3600, ", ".join(risen)))
+
+def _service_state_check(service, state):
+    @tags('smf')
+    @uses('smf_states')
+    def check(self):
+        self.assertServiceState(service, state)
+    check.__doc__ = """ %s service must always be %s """ % (service, state)
+    return check
+
+for _service, _state, _ in SMF_SERVICES:
+    setattr(BasicSystemSanity, 'test_%s_is_%s' % (_service, _state),
+        _service_state_check(_service, _state))
 
 class CustomTextTestResult(unittest.TextTestResult):
+    def cached(self, test):
+        ages = cache_ages(test)
+        if not ages:
+            return u''
+        return u' (cached: %s)' % u', '.join(u'%s %ds old' % (name, age)
+            for name, age in ages.items())
+
     def addSuccess(self, test):
         if self.showAll:
-            self.stream.writeln(u'✓')
+            self.stream.writeln(u'✓' + self.cached(test))
     
     def addFailure(self, test, err):
         super(unittest.TextTestResult, self).addFailure(test, err)
         if self.showAll:
-            self.stream.writeln(u'✗')
+            self.stream.writeln(u'✗' + self.cached(test))
         elif self.dots:
             self.stream.write('F')
             self.stream.flush()
 
+    def addError(self, test, err):
+        if not issubclass(err[0], CommandTimeout):
+            return super(CustomTextTestResult, self).addError(test, err)
+        super(unittest.TextTestResult, self).addError(test, err)
+        if self.showAll:
+            self.stream.writeln(u'TIMEOUT')
+        elif self.dots:
+            self.stream.write('T')
+            self.stream.flush()
+
     def getDescription(self, test):
         doc_first_line = test.shortDescription()
         if self.descriptions and doc_first_line:
@@ -743,11 +2475,1396 @@ class CustomTextTestResult(unittest.TextTestResult):
 
     def printErrorList(self, flavour, errors):
         for test, err in errors:
+            # The exception itself is on the last line of the traceback,
+            # whichever helper raised it.
+            exception = err.rstrip('\n').split('\n')[-1]
+            kind = flavour
+            if exception.startswith(CommandTimeout.__name__ + ":"):
+                kind = "TIMEOUT"
             self.stream.writeln(self.separator1)
-            self.stream.writeln("%s: %s" % (flavour,self.getDescription(test)))
+            self.stream.writeln("%s: %s" % (kind, self.getDescription(test)))
             self.stream.writeln(self.separator2)
-            self.stream.writeln("%s" % err.split('\n')[3])
+            self.stream.writeln("%s" % exception)
+
+class StructuredTestResult(unittest.TestResult):
+    """ Collect the outcome of each check as plain data.
+
+    A record holds the name and description of the check, its status, the
+    failure message, how long it took and the facts it reads. Subclasses
+    receive each record in `emit` as soon as its check finished.
+    """
+    # Records are self-contained, so checks are reported as they finish
+    # rather than in suite order.
+    ordered = False
+    STATUSES = ("passed", "failed", "error", "timeout", "skipped")
+
+    def __init__(self, stream=None, descriptions=None, verbosity=None):
+        super(StructuredTestResult, self).__init__(
+            stream, descriptions, verbosity)
+        self.checks = []
+        self._current = None
+
+    def startTest(self, test):
+        super(StructuredTestResult, self).startTest(test)
+        self._started = time.time()
+        self._current = collections.OrderedDict([
+            ("name", getattr(test, '_testMethodName', str(test))),
+            ("description", (test.shortDescription() or "").strip()),
+            ("status", None),
+            ("message", None),
+            ("duration", None),
+            ("sources", list(check_sources(test))),
+            ("cached", None),
+        ])
+
+    def _outcome(self, status, message=None):
+        self._current["status"] = status
+        self._current["message"] = message
+
+    def _message(self, err):
+        return traceback.format_exception_only(err[0], err[1])[-1].strip()
+
+    def addSuccess(self, test):
+        super(StructuredTestResult, self).addSuccess(test)
+        self._outcome("passed")
+
+    def addFailure(self, test, err):
+        super(StructuredTestResult, self).addFailure(test, err)
+        self._outcome("failed", self._message(err))
+
+    def addError(self, test, err):
+        super(StructuredTestResult, self).addError(test, err)
+        self._outcome("timeout" if issubclass(err[0], CommandTimeout)
+            else "error", self._message(err))
+
+    def addSkip(self, test, reason):
+        super(StructuredTestResult, self).addSkip(test, reason)
+        self._outcome("skipped", reason)
+
+    def addDuration(self, test, elapsed):
+        # Called by the parallel runner, which knows how long the check
+        # itself took, rather than how long reporting it did.
+        self._current["duration"] = round(elapsed, 3)
+
+    def stopTest(self, test):
+        super(StructuredTestResult, self).stopTest(test)
+        record, self._current = self._current, None
+        if record["duration"] is None:
+            record["duration"] = round(time.time() - self._started, 3)
+        record["cached"] = dict((name, round(age, 1))
+            for name, age in cache_ages(test).items())
+        self.checks.append(record)
+        self.emit(record)
+
+    def emit(self, record):
+        pass
+
+    def summary(self, duration):
+        return {
+            "status": "passed" if self.wasSuccessful() else "failed",
+            "tests": self.testsRun,
+            "failures": len(self.failures),
+            "errors": len(self.errors),
+            "timeouts": sum(1 for check in self.checks
+                if check["status"] == "timeout"),
+            "skipped": len(self.skipped),
+            "duration": round(duration, 3),
+            "checks": self.checks,
+        }
+
+class JsonLinesTestResult(StructuredTestResult):
+    """ Stream one JSON record per check as soon as it finishes """
+    def __init__(self, stream, descriptions=None, verbosity=None):
+        super(JsonLinesTestResult, self).__init__(
+            stream, descriptions, verbosity)
+        self.stream = stream
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+class JUnitXmlTestResult(StructuredTestResult):
+    """ Write the results as a JUnit XML report once the run is over """
+    ordered = True
+
+    def __init__(self, stream, descriptions=None, verbosity=None):
+        super(JUnitXmlTestResult, self).__init__(
+            stream, descriptions, verbosity)
+        self.stream = stream
+        self.details = {}
+
+    def addFailure(self, test, err):
+        super(JUnitXmlTestResult, self).addFailure(test, err)
+        self.details[test] = self.failures[-1][1]
+
+    def addError(self, test, err):
+        super(JUnitXmlTestResult, self).addError(test, err)
+        self.details[test] = self.errors[-1][1]
+
+    def startTestRun(self):
+        self._run_started = time.time()
+
+    def stopTestRun(self):
+        q = xml.sax.saxutils.quoteattr
+        elapsed = time.time() - getattr(self, '_run_started', time.time())
+        out = [u'<?xml version="1.0" encoding="UTF-8"?>',
+            u'<testsuite name="BasicSystemSanity" tests="%d" failures="%d" ' \
+            u'errors="%d" skipped="%d" time="%.3f" hostname=%s>' % (
+                self.testsRun, len(self.failures), len(self.errors),
+                len(self.skipped), elapsed, q(socket.gethostname()))]
+        details = dict((getattr(test, '_testMethodName', str(test)), text)
+            for test, text in self.details.items())
+        for check in self.checks:
+            out.append(u'  <testcase classname="BasicSystemSanity" ' \
+                u'name=%s time="%.3f">' % (q(check["name"]),
+                check["duration"]))
+            tag = {"failed": "failure", "error": "error",
+                "timeout": "error", "skipped": "skipped"}.get(check["status"])
+            if tag == "skipped":
+                out.append(u'    <skipped message=%s/>' % q(check["message"]))
+            elif tag is not None:
+                out.append(u'    <%s message=%s>%s</%s>' % (tag,
+                    q(check["message"]), xml.sax.saxutils.escape(
+                    details.get(check["name"], "")), tag))
+            if check["description"]:
+                out.append(u'    <system-out>%s</system-out>' % (
+                    xml.sax.saxutils.escape(check["description"])))
+            out.append(u'  </testcase>')
+        out.append(u'</testsuite>')
+        self.stream.write((u"\n".join(out) + u"\n").encode("utf-8"))
+        self.stream.flush()
+
+class _RecordingResult(unittest.TestResult):
+    """ Buffer the outcome of a single test so it can be replayed later """
+    def __init__(self):
+        super(_RecordingResult, self).__init__()
+        self.events = []
+        self.elapsed = None
+
+    def startTest(self, test):
+        super(_RecordingResult, self).startTest(test)
+        self._started = time.time()
+
+    def stopTest(self, test):
+        super(_RecordingResult, self).stopTest(test)
+        self.elapsed = time.time() - self._started
+
+    def addSuccess(self, test):
+        self.events.append(('addSuccess', ()))
+
+    def addFailure(self, test, err):
+        self.events.append(('addFailure', (err,)))
+
+    def addError(self, test, err):
+        self.events.append(('addError', (err,)))
+
+    def addSkip(self, test, reason):
+        self.events.append(('addSkip', (reason,)))
+
+    def addExpectedFailure(self, test, err):
+        self.events.append(('addExpectedFailure', (err,)))
+
+    def addUnexpectedSuccess(self, test):
+        self.events.append(('addUnexpectedSuccess', ()))
+
+    def replay(self, result, test):
+        result.startTest(test)
+        for name, args in self.events:
+            getattr(result, name)(test, *args)
+        add_duration = getattr(result, 'addDuration', None)
+        if add_duration is not None and self.elapsed is not None:
+            add_duration(test, self.elapsed)
+        result.stopTest(test)
+
+def _timed_out(test, message):
+    """ Return the recorded outcome of a check which ran out of time """
+    recorder = _RecordingResult()
+    recorder.startTest(test)
+    recorder.addError(test, (CommandTimeout, CommandTimeout(message), None))
+    recorder.stopTest(test)
+    return recorder
+
+def _iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in _iter_tests(test):
+                yield t
+        else:
+            yield test
+
+def select_checks(suite, patterns=(), tags=()):
+    """ Return a suite of the checks whose name matches any of the glob
+    patterns, with or without its `test_` prefix, or which carry any of the
+    tags. Without patterns or tags every check is selected. """
+    def selected(test):
+        if not patterns and not tags:
+            return True
+        name = test._testMethodName
+        short = name[len("test_"):] if name.startswith("test_") else name
+        return set(tags).intersection(check_tags(test)) or any(
+            fnmatch.fnmatchcase(name, pattern) or
+            fnmatch.fnmatchcase(short, pattern) for pattern in patterns)
+    return unittest.TestSuite(test for test in _iter_tests(suite)
+        if selected(test))
+
+# Raise an exception caught in another thread with the traceback it had
+# there. The Python 2 form is a syntax error to Python 3, hence the exec.
+if sys.version_info[0] < 3:
+    exec("def _reraise(exc_type, exc, tb):\n    raise exc_type, exc, tb\n")
+else:
+    def _reraise(exc_type, exc, tb):
+        raise exc.with_traceback(tb)
+
+class _ParallelSuite(object):
+    """ Callable standing in for a TestSuite, see ParallelTestRunner """
+    def __init__(self, suite, jobs):
+        self.tests = list(_iter_tests(suite))
+        self.jobs = max(1, jobs)
+
+    def __call__(self, result):
+        global BUDGET
+        tests = self.tests
+        # Every shared source is collected by a task of its own, queued ahead
+        # of the checks. Checks reading a source wait in `pending` until all
+        # of their sources were collected, successfully or not.
+        tasks = collections.deque()
+        pending = {}
+        readers = collections.OrderedDict()
+        for idx, test in enumerate(tests):
+            keys = set((type(test), name) for name in check_sources(test))
+            for key in keys:
+                readers.setdefault(key, []).append(idx)
+            if keys:
+                pending[idx] = keys
+        tasks.extend(('source', key) for key in readers)
+        tasks.extend(('test', idx) for idx in range(len(tests))
+            if idx not in pending)
+        commands = set(key for key in readers
+            if key[0].facts.facts[key[1]].argv is not None)
+        budget = BUDGET = Budget(len(commands), self.jobs)
+
+        done = {}
+        cond = threading.Condition()
+        # Results which do not care for suite order get each outcome as soon
+        # as it is in, one at a time.
+        ordered = getattr(result, 'ordered', True)
+        report_lock = threading.Lock()
+        # A worker that fails reporting, e.g. into a closed pipe, would leave
+        # the suite waiting forever, so its error is passed on instead.
+        failed = []
+
+        def report(idx, recorder):
+            # Only the first outcome of a check counts, a check given up on
+            # for running past the deadline may still finish later.
+            with report_lock:
+                with cond:
+                    if idx in done:
+                        return
+                if not ordered:
+                    recorder.replay(result, tests[idx])
+                with cond:
+                    done[idx] = recorder
+                    cond.notify_all()
+
+        def overdue():
+            return DEADLINE is not None and \
+                time.time() > DEADLINE + DEADLINE_GRACE
+
+        def worker():
+            try:
+                work()
+            except BaseException:
+                with cond:
+                    failed.append(sys.exc_info())
+                    cond.notify_all()
+
+        def work():
+            while True:
+                with cond:
+                    while not tasks and len(done) < len(tests):
+                        cond.wait()
+                    if not tasks:
+                        return
+                    kind, item = tasks.popleft()
+                if kind == 'source':
+                    cls, name = item
+                    cls.collect_source(name)
+                    with cond:
+                        if item in commands:
+                            budget.collected()
+                        for idx in readers[item]:
+                            pending[idx].discard(item)
+                            if not pending[idx]:
+                                tasks.append(('test', idx))
+                        cond.notify_all()
+                elif overdue():
+                    report(item, _timed_out(tests[item],
+                        "not run, past the deadline"))
+                else:
+                    recorder = _RecordingResult()
+                    tests[item](recorder)
+                    report(item, recorder)
+
+        for _ in range(min(self.jobs, len(tests))):
+            t = threading.Thread(target=_profiled(worker))
+            t.daemon = True
+            t.start()
+
+        # Report in suite order as soon as each prefix of the suite finished,
+        # or only wait for the suite to finish if that was done already.
+        # Checks still unfinished well past the deadline are given up on.
+        for idx, test in enumerate(tests):
+            with cond:
+                while idx not in done and not failed and not overdue():
+                    # A timeout keeps the main thread responsive to ^C.
+                    cond.wait(0.5)
+                if failed:
+                    _reraise(*failed[0])
+            if idx not in done:
+                report(idx, _timed_out(test, "did not finish by the deadline"))
+            if ordered:
+                done[idx].replay(result, test)
+
+        for cls in collections.OrderedDict((type(t), None) for t in tests):
+            cls.tearDownClass()
+        BUDGET = None
+        return result
+
+def run_checks(suite, result, jobs):
+    """ Run a suite in parallel into a result, without a TextTestRunner """
+    start_run = getattr(result, 'startTestRun', None)
+    if start_run is not None:
+        start_run()
+    try:
+        _ParallelSuite(suite, jobs)(result)
+    finally:
+        stop_run = getattr(result, 'stopTestRun', None)
+        if stop_run is not None:
+            stop_run()
+    return result
+
+class ParallelTestRunner(unittest.TextTestRunner):
+    """ Run checks in a bounded pool of worker threads.
+
+    Shared data sources declared with @uses stand in for the class fixture,
+    each is collected by a task of its own, and a check is dispatched only
+    once every source it reads has been collected. Checks of a source that
+    failed are then skipped straight away. Results are reported in suite order
+    regardless of the order in which checks complete.
+    """
+    def __init__(self, jobs=DEFAULT_JOBS, **kwargs):
+        super(ParallelTestRunner, self).__init__(**kwargs)
+        self.jobs = jobs
+
+    def run(self, test):
+        return super(ParallelTestRunner, self).run(
+            _ParallelSuite(test, self.jobs))
+
+def _with_dependents(facts, names):
+    """ Return names along with every fact computed from any of them, however
+    indirectly """
+    names = set(names)
+    grown = True
+    while grown:
+        grown = False
+        for name, fact in facts.items():
+            if name not in names and names.intersection(fact.needs):
+                names.add(name)
+                grown = True
+    return names
+
+class ResidentState(object):
+    """ Facts kept warm and check results kept current by the daemon.
+
+    Each fact is collected again once it is older than its `refresh`
+    interval, and only the checks reading a refreshed fact are run again.
+    """
+    def __init__(self, case, jobs):
+        self.case = case
+        self.jobs = jobs
+        self.tests = list(_iter_tests(
+            unittest.TestLoader().loadTestsFromTestCase(case)))
+        self.readers = collections.OrderedDict()
+        for test in self.tests:
+            for name in check_sources(test):
+                self.readers.setdefault(name, []).append(test)
+        # Facts read by checks, and those they are computed from, however
+        # indirectly.
+        self.facts = collections.OrderedDict((name, None)
+            for name in self.readers)
+        pending = list(self.facts)
+        while pending:
+            for need in self.case.facts.facts[pending.pop()].needs:
+                if need not in self.facts:
+                    self.facts[need] = None
+                    pending.append(need)
+        self.results = collections.OrderedDict()
+        # Outcome of the latest collection of each fact, and when it ended.
+        self.collected = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ Refresh the facts which are due and run the checks reading them.
+
+        Returns the number of seconds until the next fact is due.
+        """
+        store = self.case.facts
+        due = set()
+        for name in self.facts:
+            age = store.age(name)
+            if age is None or age >= store.facts[name].refresh:
+                due.add(name)
+        due = _with_dependents(dict((name, store.facts[name])
+            for name in self.facts), due)
+        for name in due:
+            store.invalidate(name)
+        tests = [test for test in self.tests
+            if due.intersection(check_sources(test))]
+        if tests:
+            result = run_checks(tests, StructuredTestResult(), self.jobs)
+            finished = time.time()
+            outcomes = dict((name, store.outcome(name)) for name in due)
+            with self.lock:
+                for check in result.checks:
+                    self.results[check["name"]] = dict(check,
+                        finished=finished)
+                for name, outcome in outcomes.items():
+                    if outcome is not None:
+                        self.collected[name] = outcome + (finished,)
+        return max(1, min(store.facts[name].refresh - (store.age(name) or 0)
+            for name in self.facts))
+
+    def run_forever(self):
+        while True:
+            time.sleep(self.refresh())
+
+    def snapshot(self, names=None):
+        """ Return the latest results, with their age and that of facts """
+        now = time.time()
+        with self.lock:
+            checks = [dict(check, age=round(now - check["finished"], 3))
+                for name, check in self.results.items()
+                if not names or name in names]
+        store = self.case.facts
+        facts = dict((name, store.age(name)) for name in self.readers)
+        return {"checks": checks, "facts": facts}
+
+    def exported(self):
+        """ Return the latest results and fact outcomes, for the exporter """
+        with self.lock:
+            return list(self.results.values()), dict(self.collected)
+
+def _metric_labels(**labels):
+    def escape(value):
+        return unicode(value).replace(u'\\', u'\\\\').replace(
+            u'"', u'\\"').replace(u'\n', u'\\n')
+    return u"{%s}" % u",".join(u'%s="%s"' % (name, escape(value))
+        for name, value in sorted(labels.items()) if value is not None)
+
+def render_metrics(checks, collected, now=None):
+    """ Return OpenMetrics text exposing the outcome of checks and facts.
+
+    Only what the daemon already collected is read, nothing is run.
+    """
+    now = time.time() if now is None else now
+    families = collections.OrderedDict()
+    def sample(family, kind, help, labels, value, suffix=""):
+        if family not in families:
+            families[family] = [u"# TYPE %s %s" % (family, kind),
+                u"# HELP %s %s" % (family, help)]
+        families[family].append(u"%s%s%s %s" % (family, suffix,
+            _metric_labels(**labels), repr(float(value))))
+
+    for check in checks:
+        for status in StructuredTestResult.STATUSES:
+            sample("healthcheck_check", "stateset", "Outcome of each check.",
+                {"check": check["name"], "healthcheck_check": status},
+                check["status"] == status)
+        sample("healthcheck_check_duration_seconds", "gauge",
+            "Seconds each check took.", {"check": check["name"]},
+            check["duration"])
+    for name, (_, error, duration, finished) in sorted(collected.items()):
+        sample("healthcheck_fact_up", "gauge",
+            "Whether the latest collection of a fact succeeded.",
+            {"fact": name}, error is None)
+        sample("healthcheck_fact_collection_seconds", "gauge",
+            "Seconds the latest collection of a fact took.",
+            {"fact": name}, duration)
+        sample("healthcheck_fact_age_seconds", "gauge",
+            "Seconds since a fact was last collected.",
+            {"fact": name}, now - finished)
+
+    drives = collected.get('drives', (None, None))
+    for drive in drives[0] or ():
+        if not drive.serial:
+            continue
+        temperature = getattr(drive.hwadm, 'temperature', None)
+        if temperature is not None:
+            sample("healthcheck_drive_temperature_celsius", "gauge",
+                "Temperature of each drive.", {"serial": drive.serial,
+                "enclosure": drive.enclosure, "bay": drive.bay}, temperature)
+        for stat in SDERR_COUNTERS:
+            count = (drive.sderr or {}).get(stat)
+            if isinstance(count, (int, long)):
+                sample("healthcheck_drive_sderr_errors", "counter",
+                    "Errors counted by the sd driver for each drive.",
+                    {"serial": drive.serial, "instance": drive.instance,
+                    "error": stat}, count, suffix="_total")
+    sdr = collected.get('ipmi_sdr', (None, None))
+    for sensor in (sdr[0] or {}).get(u'IPMISDRDUMP') or ():
+        if u'Health' in sensor:
+            sample("healthcheck_sensor_ok", "gauge",
+                "Whether each BMC sensor reports a healthy state.",
+                {"sensor": sensor[u'Name'], "health": sensor[u'Health']},
+                sensor[u'Health'] in (u'ok', u'ns'))
+        if isinstance(sensor.get(u'Value'), (int, long, float)):
+            sample("healthcheck_sensor_value", "gauge",
+                "Reading of each BMC sensor.", {"sensor": sensor[u'Name']},
+                sensor[u'Value'])
+    lines = [line for family in families.values() for line in family]
+    return u"\n".join(lines + [u"# EOF", u""])
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_metrics(*self.server.state.exported()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", self.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are too frequent to log
+
+class _MetricsServer(SocketServer.ThreadingMixIn,
+    BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def parse_address(spec, host="127.0.0.1"):
+    """ Split [HOST:]PORT into a host and port, listening on localhost
+    unless a host is given """
+    if ":" in spec:
+        host, spec = spec.rsplit(":", 1)
+    return host, int(spec)
+
+class _ClientHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or "{}")
+        except ValueError:
+            request = {}
+        reply = self.server.state.snapshot(request.get("checks"))
+        self.wfile.write(json.dumps(reply) + "\n")
+
+class _DaemonServer(SocketServer.ThreadingMixIn,
+    SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def run_daemon(path, jobs, exporter=None):
+    """ Keep facts and results warm, answering clients on a Unix socket, and
+    scrapes over HTTP on the exporter address if any """
+    state = ResidentState(BasicSystemSanity, jobs)
+    state.refresh()
+    if os.path.exists(path):
+        os.unlink(path)
+    servers = [_DaemonServer(path, _ClientHandler)]
+    if exporter is not None:
+        servers.append(_MetricsServer(exporter, _MetricsHandler))
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    for server in servers:
+        server.state = state
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+    try:
+        state.run_forever()
+    finally:
+        for server in servers:
+            server.server_close()
+        os.unlink(path)
+
+def query_daemon(path, names=None, stream=sys.stdout):
+    """ Print the latest results held by the daemon, returns exit status """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall(json.dumps({"checks": names}) + "\n")
+        reply = json.loads(sock.makefile().read())
+    finally:
+        sock.close()
+    marks = {
+        "passed": u'\u2713',
+        "failed": u'\u2717',
+        "error": u'ERROR',
+        "timeout": u'TIMEOUT',
+        "skipped": u'skipped',
+    }
+    for check in reply["checks"]:
+        line = u" %s  ... %s (%ds ago)" % (check["description"],
+            marks.get(check["status"], check["status"]), check["age"])
+        if check["status"] != "passed" and check["message"]:
+            line += u"\n    %s" % check["message"]
+        stream.write((line + u"\n").encode("utf-8"))
+    failed = [c for c in reply["checks"]
+        if c["status"] in ("failed", "error", "timeout")]
+    return 1 if failed else 0
+
+class PollingWatcher(object):
+    """ Notice changes to files and directories by comparing their status
+    every `interval` seconds. Works anywhere, see InotifyWatcher """
+    def __init__(self, paths, interval=1.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self._status = dict((path, self._stat(path)) for path in self.paths)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+    def wait(self, timeout=None):
+        """ Return the set of paths which changed, waiting up to timeout
+        seconds, or for good, for any to change """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path in self.paths:
+                status = self._stat(path)
+                if status != self._status[path]:
+                    self._status[path] = status
+                    changed.add(path)
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+            time.sleep(self.interval if deadline is None else
+                max(0, min(self.interval, deadline - time.time())))
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """ Notice changes to files and directories through Linux inotify.
+
+    The directory holding each file is watched rather than the file itself,
+    so that a file which is rotated, replaced or created later is still
+    followed. The parent of each directory watched is watched too, so that
+    a directory which is removed or moved away is watched again once it is
+    back. Raises OSError where inotify is not available.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_IGNORED = 0x8000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct("iIII")   # wd, mask, cookie, length of the name
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = libc
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Each directory maps to the paths it covers, with the name of the
+        # file within it, or None for changes anywhere in it, and each parent
+        # to the directories within it by name.
+        self._covers = collections.defaultdict(list)
+        self._children = collections.defaultdict(dict)
+        self._watches = {}
+        try:
+            for path in paths:
+                if os.path.isdir(path):
+                    directory, name = path, None
+                else:
+                    directory, name = os.path.split(path)
+                self._covers[directory].append((path, name))
+            for directory in list(self._covers):
+                parent, name = os.path.split(directory)
+                if name:
+                    self._children[parent][name] = directory
+            for directory in set(self._covers).union(self._children):
+                self._watch(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, directory):
+        # Parents only need telling when a directory watched is back.
+        mask = self.MASK if directory in self._covers else \
+            self.IN_CREATE | self.IN_MOVED_TO
+        wd = self._libc.inotify_add_watch(self.fd,
+            directory.encode("utf-8"), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "cannot watch %s" % directory)
+        self._watches[wd] = directory
+
+    def _rewatch(self, directory):
+        """ Watch a directory again once it is back, returning the paths it
+        covers, which changed along with it """
+        if directory in self._watches.values() or \
+            not os.path.isdir(directory):
+            return ()
+        try:
+            self._watch(directory)
+        except OSError:
+            return ()
+        return [path for path, _ in self._covers.get(directory, ())]
+
+    def wait(self, timeout=None):
+        """ Return the set of paths which changed, waiting up to timeout
+        seconds, or for good, for any to change """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF |
+                self.IN_IGNORED):
+                # The watch of a directory moved away would follow it.
+                if mask & self.IN_MOVE_SELF:
+                    self._libc.inotify_rm_watch(self.fd, wd)
+                del self._watches[wd]
+                changed.update(path for path, _ in self._covers[directory])
+                changed.update(self._rewatch(directory))
+                continue
+            for path, watched in self._covers.get(directory, ()):
+                if watched is None or watched.encode("utf-8") == name:
+                    changed.add(path)
+            for child, below in self._children.get(directory, {}).items():
+                if child.encode("utf-8") == name:
+                    changed.update(self._rewatch(below))
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def make_watcher(spec, paths):
+    """ Watch paths with inotify, by polling, or with inotify where it is
+    available and by polling elsewhere for "auto" """
+    if spec == "poll":
+        return PollingWatcher(paths)
+    if spec == "inotify":
+        return InotifyWatcher(paths)
+    if spec == "auto":
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, TypeError):
+            return PollingWatcher(paths)
+    raise ValueError("unknown watch backend '%s'" % spec)
+
+def watch_checks(tests, watcher, run, debounce=WATCH_DEBOUNCE):
+    """ Run checks again whenever the files their facts are read from
+    change, until interrupted.
+
+    Changes coming in bursts, such as a core being written, are gathered
+    until none came for `debounce` seconds. The facts read from the changed
+    files, and those computed from them, are then collected afresh, and the
+    checks reading any of them run again with `run`.
+    """
+    store = BasicSystemSanity.facts
+    watched = {}
+    for name, fact in store.facts.items():
+        for path in fact.paths:
+            watched.setdefault(_rooted(path), set()).add(name)
+    try:
+        while True:
+            changed = watcher.wait()
+            while changed:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            stale = set()
+            for path in changed:
+                stale.update(watched.get(path, ()))
+            # Facts computed from stale ones are stale too.
+            stale = _with_dependents(store.facts, stale)
+            affected = [test for test in tests
+                if stale.intersection(check_sources(test))]
+            if not affected:
+                continue
+            for name in stale:
+                store.invalidate(name)
+            run(unittest.TestSuite(affected), sorted(changed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def _unit_key(unit, n):
+    # Units by serial, else by the paths to them, which do not change with
+    # the order hwadm lists them in. Only a unit without either, such as a
+    # head reporting no serial, falls back to its position.
+    if unit.serial:
+        return "unit %s" % unit.serial
+    if unit.paths:
+        return "unit at %s" % ",".join(sorted(unit.paths))
+    return "head unit" if unit.is_head else "unit %d" % n
+
+def _hardware_records(hardware):
+    for drive in hardware.drives:
+        if drive.serial:
+            yield "drive %s" % drive.serial, _slots(drive)
+        else:
+            yield "drive in bay %s of enclosure %s" % (drive.bay,
+                drive.enclosure), _slots(drive)
+    for n, unit in enumerate(hardware.units):
+        key = _unit_key(unit, n)
+        yield key, {"serial": unit.serial, "part_number": unit.part_number,
+            "is_head": unit.is_head, "paths": list(unit.paths)}
+        for sensor in unit.sensors:
+            yield "sensor %s of %s" % (sensor.name, key), _slots(sensor)
+        for bay in unit.bays or ():
+            yield "bay %s of %s" % (bay.number, key), _slots(bay)
+
+def _vdev_records(pools):
+    def walk(vdev, path):
+        path = "%s/%s" % (path, vdev.name) if path else vdev.name
+        yield "vdev %s" % path, {"health": vdev.health,
+            "errors": list(vdev.errors)}
+        for child in vdev.children:
+            for record in walk(child, path):
+                yield record
+    for pool in pools.values():
+        for record in walk(pool, ""):
+            yield record
+
+def _svcs_explain_records(output):
+    # svcs -xv explains each service in a paragraph of its own, starting
+    # with its FMRI.
+    for paragraph in output.strip().split("\n\n"):
+        if paragraph.strip():
+            yield paragraph.split()[0], paragraph.strip()
+
+def _slots(record):
+    return dict((name, getattr(record, name)) for name in record.__slots__)
+
+# How to split the value of a fact into records compared one by one by
+# --diff, each a (key, data) pair. Other facts are compared whole.
+DIFF_RECORDS = {
+    'hwadm': _hardware_records,
+    'secadm': lambda secadm: [("drive %s" % drive[u'Serial'], drive)
+        for drive in secadm.get(u'Drives') or ()] +
+        [("pool %s" % pool[u'Name'], pool)
+        for pool in secadm.get(u'Pools') or ()],
+    'sderr': lambda sderr: [("%s (serial %s)" % (instance,
+        data.get(u'Serial No', u'').strip()), data)
+        for instance, data in sderr.items()],
+    'ipmi_sdr': lambda sdr: [("sensor %s" % sensor[u'Name'], sensor)
+        for sensor in sdr.get(u'IPMISDRDUMP') or ()],
+    'ipmi_chassis': lambda pairs: [(pair[0], list(pair[1:]))
+        for pair in pairs],
+    'smf_states': lambda pairs: pairs,
+    'smf_explain': _svcs_explain_records,
+    'zpools': _vdev_records,
+    'zfs_properties': lambda values: [("%s %s" % key, value)
+        for key, value in values.items()],
+    'cores': lambda filenames: [("core %s" % name, True)
+        for name in filenames],
+}
+
+# Facts not compared by --diff: the raw IPMI answers are compared through the
+# facts split from them, the drive inventory through its sources, and the
+# history is that of the system diffing, not of the snapshots.
+DIFF_SKIPPED = frozenset(['ipmi', 'drives', 'history'])
+
+def _digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True,
+        default=repr)).hexdigest()
+
+class Snapshot(object):
+    """ The facts saved in a bundle by --record, for --diff.
+
+    Each fact has a hash, that of its command's output, which the bundle
+    already names objects by, or of its recorded value, or of the facts it
+    is computed from. Facts with the same hash in two snapshots are skipped
+    without reading their output. The others are split into records, each
+    with a hash of its own, so that only records which differ are compared.
+    """
+    def __init__(self, path):
+        self.store = ReplayFactStore(path)
+        self._hashes = {}
+
+    def hash(self, name):
+        if name not in self._hashes:
+            fact = self.store.facts[name]
+            if fact.needs:
+                parts = [self.hash(need) for need in fact.needs]
+            elif fact.argv is not None:
+                command = dict(self.store.recorded(fact.argv) or {})
+                command.pop("elapsed", None)
+                parts = [command]
+            else:
+                parts = [self.store.index["facts"].get(name)]
+            self._hashes[name] = _digest(parts)
+        return self._hashes[name]
+
+    def records(self, name):
+        """ Return the hash and data of each record of a fact, by key """
+        try:
+            value = self.store.get(name)
+        except Exception as e:
+            pairs = [("unavailable", str(e) or e.__class__.__name__)]
+        else:
+            pairs = DIFF_RECORDS.get(name,
+                lambda value: [("value", value)])(value)
+        return collections.OrderedDict((key, (_digest(data), data))
+            for key, data in pairs)
+
+def _changed_fields(before, after, path=""):
+    if isinstance(before, dict) and isinstance(after, dict):
+        changed = []
+        for key in sorted(set(before) | set(after)):
+            changed.extend(_changed_fields(before.get(key), after.get(key),
+                "%s.%s" % (path, key) if path else key))
+        return changed
+    return [] if before == after else [(path or "value", before, after)]
+
+def diff_snapshots(old, new):
+    """ Return each record which differs between two snapshots, as
+    (fact, key, change, fields), change being one of +, - and ~ and fields
+    the (field, before, after) of a changed record """
+    changes = []
+    for name in sorted(old.store.facts):
+        if name in DIFF_SKIPPED or old.hash(name) == new.hash(name):
+            continue
+        before, after = old.records(name), new.records(name)
+        for key in list(before) + [key for key in after if key not in before]:
+            if key not in after:
+                changes.append((name, key, "-", []))
+            elif key not in before:
+                changes.append((name, key, "+", []))
+            elif before[key][0] != after[key][0]:
+                changes.append((name, key, "~",
+                    _changed_fields(before[key][1], after[key][1])))
+    return changes
+
+def report_diff(changes, stream):
+    """ Print changes by fact, returns exit status """
+    fact = None
+    for name, key, change, fields in changes:
+        if name != fact:
+            stream.write("%s:\n" % name)
+            fact = name
+        line = u"  %s %s" % (change, key)
+        if fields:
+            line += u": " + u", ".join(u"%s %s -> %s" % field
+                for field in fields)
+        stream.write((line + u"\n").encode("utf-8"))
+    return 1 if changes else 0
+
+class LocalTransport(object):
+    """ Run commands on this machine, whatever the host """
+    def popen(self, host, argv, **kwargs):
+        return subprocess.Popen(argv, **kwargs)
+
+class SshTransport(object):
+    """ Run commands on a host over ssh, without prompting for anything """
+    def __init__(self, options=("-o", "BatchMode=yes",
+        "-o", "ConnectTimeout=10")):
+        self.options = list(options)
+
+    def popen(self, host, argv, **kwargs):
+        return subprocess.Popen(["ssh"] + self.options + [host, "--",
+            " ".join(pipes.quote(arg) for arg in argv)], **kwargs)
+
+class StubTransport(object):
+    """ Stand in for hosts with canned output, for testing.
+
+    The output for a host is read from `<directory>/<host>.json`.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def popen(self, host, argv, **kwargs):
+        return subprocess.Popen(
+            ["cat", os.path.join(self.directory, "%s.json" % host)], **kwargs)
+
+def make_transport(spec):
+    if spec == "ssh":
+        return SshTransport()
+    if spec == "local":
+        return LocalTransport()
+    if spec.startswith("stub:"):
+        return StubTransport(spec[len("stub:"):])
+    raise ValueError("unknown transport '%s'" % spec)
+
+def read_hosts(path):
+    """ Read host names, one per line, ignoring blank lines and comments """
+    with open(path) as f:
+        return [line.split("#")[0].strip() for line in f
+            if line.split("#")[0].strip()]
+
+def _check_host(host, transport, argv, source, timeout):
+    result = {"host": host}
+    started = time.time()
+    try:
+        # In a process group of its own, so that the whole group can be
+        # killed on timeout instead of leaving children holding the pipes.
+        proc = transport.popen(host, argv, stdin=PIPE, stdout=PIPE,
+            stderr=PIPE, preexec_fn=os.setsid)
+    except OSError as e:
+        result.update(status="error", message=str(e))
+        return result
+    SUPERVISOR.watch(proc, started + timeout)
+    try:
+        stdout, stderr = proc.communicate(source)
+    finally:
+        killed = SUPERVISOR.release(proc)
+    duration = round(time.time() - started, 3)
+    if killed:
+        result.update(status="timeout", duration=duration,
+            message="no result within %gs" % timeout)
+        return result
+    try:
+        result.update(json.loads(stdout))
+    except ValueError:
+        lines = stderr.strip().splitlines() or ["no result"]
+        result.update(status="error", message=lines[-1])
+    result["duration"] = duration
+    return result
+
+def run_fleet(hosts, transport, argv, source, jobs, timeout,
+    stream=sys.stdout, progress=sys.stderr):
+    """ Run the suite on many hosts concurrently, one process per host.
+
+    The script itself is fed to `argv`, run on each host through the
+    transport, which reports in JSON. One result per host is written to
+    `stream` as a line of JSON in the order hosts finish, with a progress
+    line for each on `progress`. Returns the results in host order.
+    """
+    queue = collections.deque(hosts)
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                host = queue.popleft()
+            result = _check_host(host, transport, argv, source, timeout)
+            with lock:
+                results[host] = result
+                stream.write(json.dumps(result, sort_keys=True) + "\n")
+                stream.flush()
+                progress.write("[%d/%d] %s: %s (%.1fs)\n" % (
+                    len(results), len(hosts), host, result["status"],
+                    result.get("duration", 0)))
+                progress.flush()
+
+    workers = [threading.Thread(target=worker)
+        for _ in range(min(jobs, len(hosts)))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        while t.is_alive():
+            # A timeout keeps the main thread responsive to ^C.
+            t.join(0.5)
+    return [results[host] for host in hosts]
+
+def run_suite(args, suite=None, stream=None):
+    """ Run the checks once, reporting as asked by the command line """
+    if suite is None:
+        suite = select_checks(
+            unittest.TestLoader().loadTestsFromTestCase(BasicSystemSanity),
+            args.check, args.tag)
+    if stream is None:
+        stream = sys.stdout if args.output is None else open(args.output, "w")
+    if args.format == "json":
+        started = time.time()
+        result = run_checks(suite, StructuredTestResult(), args.jobs)
+        json.dump(result.summary(time.time() - started), stream)
+        stream.write("\n")
+    elif args.format == "jsonl":
+        run_checks(suite, JsonLinesTestResult(stream), args.jobs)
+    elif args.format == "junit":
+        run_checks(suite, JUnitXmlTestResult(stream), args.jobs)
+    else:
+        ParallelTestRunner(stream=stream, jobs=args.jobs, verbosity=2,
+            resultclass=CustomTextTestResult).run(suite)
+
+def watched_paths(tests):
+    """ Return the files read by facts the checks read, directly or not """
+    store = BasicSystemSanity.facts
+    names = set()
+    pending = [name for test in tests for name in check_sources(test)]
+    while pending:
+        name = pending.pop()
+        if name not in names:
+            names.add(name)
+            pending.extend(store.facts[name].needs)
+    return sorted(set(_rooted(path)
+        for name in names for path in store.facts[name].paths))
+
+def run_watch(args, tests, watcher):
+    """ Run the checks, then run again those reading files which changed """
+    stream = sys.stdout if args.output is None else open(args.output, "w")
+    run_suite(args, unittest.TestSuite(tests), stream)
+    def rerun(suite, changed):
+        if args.format == "text":
+            stream.write("\n%s changed\n" % ", ".join(changed))
+        run_suite(args, suite, stream)
+        stream.flush()
+    watch_checks(tests, watcher, rerun)
+
+def run_profiled(args):
+    """ Run the checks once, under the profiler if asked for """
+    global PROFILER
+    if args.profile:
+        PROFILER = Profiler(cprofile=args.profile_out is not None)
+        try:
+            return _profiled(run_suite)(args)
+        finally:
+            PROFILER.report(sys.stderr)
+            if args.profile_out is not None:
+                PROFILER.dump_stats(args.profile_out)
+    return run_suite(args)
+
+def main(argv=None):
+    global STATE_DIR, ROOT, DEADLINE, COMMAND_TIMEOUT, CACHE
+    parser = argparse.ArgumentParser(
+        description="Basic sanity checks for BrickStor hardware.")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help="number of checks to run concurrently (default: %(default)d)")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+        help="directory keeping state between runs (default: %(default)s)")
+    parser.add_argument("--root", default=ROOT,
+        help="run commands and read system files below ROOT, e.g. of a " \
+            "simulated system (default: %(default)s)")
+    parser.add_argument("--deadline", metavar="SECONDS", type=float,
+        help="finish the run within SECONDS, reporting whatever did not " \
+            "complete by then as timed out")
+    parser.add_argument("--command-timeout", metavar="SECONDS", type=float,
+        default=COMMAND_TIMEOUT, help="seconds any single command may run " \
+            "(default: %(default)g)")
+    parser.add_argument("--no-cache", action="store_true",
+        help="run every command, rather than reuse output of slow " \
+            "commands saved by earlier runs")
+    parser.add_argument("--max-age", metavar="SECONDS", type=float,
+        help="reuse saved output up to SECONDS old, instead of as long as " \
+            "each command allows")
+    parser.add_argument("--log-allow", metavar="REGEX", action="append",
+        default=[], help="ignore kernel log messages matching REGEX, " \
+            "may be repeated")
+    parser.add_argument("--log-audit", metavar="DAYS", type=float,
+        help="instead of running checks, report kernel warnings and " \
+            "errors in the log and its archives over the last DAYS")
+    parser.add_argument("--format",
+        choices=("text", "json", "jsonl", "junit"), default="text",
+        help="report as text, a JSON summary, a stream of JSON lines with " \
+            "one record per check, or JUnit XML (default: %(default)s)")
+    parser.add_argument("-o", "--output", metavar="PATH",
+        help="write the report to PATH instead of stdout")
+    parser.add_argument("--profile", action="store_true",
+        help="report on stderr the slowest commands, facts and checks")
+    parser.add_argument("--profile-out", metavar="PATH",
+        help="with --profile, also save cProfile statistics of the run " \
+            "to PATH, for use with the pstats module")
+    parser.add_argument("--record", metavar="BUNDLE",
+        help="save the output of every command run, and other collected " \
+            "data, to BUNDLE for --replay")
+    parser.add_argument("--replay", metavar="BUNDLE",
+        help="run the checks against data saved by --record instead of " \
+            "the system")
+    parser.add_argument("--diff", metavar=("OLD", "NEW"), nargs=2,
+        help="instead of running checks, show which collected data " \
+            "differs between two bundles saved by --record")
+    parser.add_argument("--fleet", metavar="HOSTS",
+        help="run the checks on every host listed in the file HOSTS and " \
+            "report one JSON result per host")
+    parser.add_argument("--transport", default="ssh",
+        help="how to reach fleet hosts: ssh, local, or stub:DIR with " \
+            "canned results in DIR/<host>.json (default: %(default)s)")
+    parser.add_argument("--fleet-jobs", type=int, default=32,
+        help="number of hosts checked concurrently (default: %(default)d)")
+    parser.add_argument("--host-timeout", type=float, default=300,
+        help="seconds allowed for each host (default: %(default)g)")
+    parser.add_argument("--remote-python", default="python",
+        help="interpreter to run the checks with on fleet hosts " \
+            "(default: %(default)s)")
+    parser.add_argument("--daemon", action="store_true",
+        help="stay resident, keep facts and results current, and answer " \
+            "--client queries")
+    parser.add_argument("--exporter", metavar="[HOST:]PORT",
+        help="with --daemon, also serve the latest results as OpenMetrics " \
+            "over HTTP on PORT, of localhost unless HOST is given")
+    parser.add_argument("--client", action="store_true",
+        help="print the latest results held by the daemon")
+    parser.add_argument("--socket", metavar="PATH",
+        help="Unix socket of the daemon (default: STATE_DIR/healthcheck.sock)")
+    parser.add_argument("--watch", action="store_true",
+        help="after running the checks, keep watching the files they read, " \
+            "such as the kernel log and /var/cores, and run the affected " \
+            "checks again whenever these change")
+    parser.add_argument("--watch-backend", choices=("auto", "inotify", "poll"),
+        default="auto", help="how to watch files: inotify, polling their " \
+            "status every second, or inotify where available " \
+            "(default: %(default)s)")
+    parser.add_argument("-c", "--check", metavar="PATTERN",
+        action="append", default=[], help="run the checks whose name " \
+            "matches the glob PATTERN, may be repeated")
+    parser.add_argument("-t", "--tag", action="append", default=[],
+        help="run the checks tagged TAG, e.g. smf, drives, enclosures, " \
+            "ipmi, zfs, logs, fma or platform, may be repeated")
+    parser.add_argument("--list-checks", action="store_true",
+        help="print the selected checks with their tags, and exit")
+    parser.add_argument("--list-services", metavar="STATE", nargs="?",
+        const="", help="print the services expected to be in STATE, or " \
+            "all checked services, and exit")
+    parser.add_argument("--list-services-to-enable", action="store_true",
+        help="print the services enablesvcs.sh enables, and exit")
+    args = parser.parse_args(argv)
+
+    STATE_DIR = args.state_dir
+    ROOT = os.path.abspath(args.root)
+    COMMAND_TIMEOUT = args.command_timeout
+    KERNEL_LOG_ALLOW.extend(args.log_allow)
+
+    if args.list_services is not None:
+        for service, state, _ in SMF_SERVICES:
+            if args.list_services in ("", state):
+                sys.stdout.write("%s\n" % service)
+        return
+
+    if args.list_services_to_enable:
+        for service, _, enable in SMF_SERVICES:
+            if enable:
+                sys.stdout.write("%s\n" % service)
+        return
+
+    if args.log_audit is not None:
+        return 1 if audit_kernel_logs(args.log_audit) else 0
+
+    if args.diff is not None:
+        try:
+            snapshots = [Snapshot(path) for path in args.diff]
+        except (IOError, zipfile.BadZipfile, KeyError, ValueError) as e:
+            parser.error("cannot read bundle: %s" % e)
+        changes = diff_snapshots(*snapshots)
+        stream = sys.stdout if args.output is None else open(args.output, "w")
+        if args.format == "json":
+            json.dump([{"fact": name, "record": key, "change": change,
+                "fields": [{"field": field, "before": before,
+                "after": after} for field, before, after in fields]}
+                for name, key, change, fields in changes], stream,
+                default=repr)
+            stream.write("\n")
+            return 1 if changes else 0
+        return report_diff(changes, stream)
+
+    checks = list(_iter_tests(select_checks(
+        unittest.TestLoader().loadTestsFromTestCase(BasicSystemSanity),
+        args.check, args.tag)))
+    if not checks:
+        parser.error("no checks selected")
+    if args.list_checks:
+        for test in checks:
+            sys.stdout.write("%s %s\n" % (test._testMethodName,
+                ",".join(check_tags(test))))
+        return
+
+    socket_path = args.socket or os.path.join(STATE_DIR, "healthcheck.sock")
+    exporter = None
+    if args.exporter is not None:
+        if not args.daemon:
+            parser.error("--exporter needs --daemon")
+        try:
+            exporter = parse_address(args.exporter)
+        except ValueError:
+            parser.error("--exporter expects [HOST:]PORT")
+    if args.client:
+        return query_daemon(socket_path, [test._testMethodName
+            for test in checks] if args.check or args.tag else None)
+    if args.daemon:
+        if not os.path.isdir(STATE_DIR):
+            os.makedirs(STATE_DIR, 0o700)
+        return run_daemon(socket_path, args.jobs, exporter)
+
+    if args.fleet is not None:
+        try:
+            with open(os.path.abspath(__file__)) as f:
+                source = f.read()
+        except (NameError, IOError):
+            parser.error("--fleet needs the script to be run from a file")
+        # Leave hosts time to report whatever they got through.
+        remote = [args.remote_python, "-", "--format", "json",
+            "--jobs", str(args.jobs), "--deadline",
+            "%g" % max(1, args.host_timeout * 0.9 - DEADLINE_GRACE)]
+        for pattern in args.check:
+            remote.extend(["--check", pattern])
+        for tag in args.tag:
+            remote.extend(["--tag", tag])
+        results = run_fleet(read_hosts(args.fleet),
+            make_transport(args.transport), remote, source,
+            args.fleet_jobs, args.host_timeout)
+        return 0 if all(r["status"] == "passed" for r in results) else 1
+
+    if args.watch:
+        if args.record is not None or args.replay is not None:
+            parser.error("--watch cannot be combined with --record or " \
+                "--replay")
+        if args.format == "junit":
+            parser.error("--watch cannot report as JUnit XML")
+        paths = watched_paths(checks)
+        if not paths:
+            parser.error("none of the selected checks read files to watch")
+        # Watch before the first run, so that no change meanwhile is missed.
+        try:
+            watcher = make_watcher(args.watch_backend, paths)
+        except OSError as e:
+            parser.error("cannot watch files: %s" % e)
+        CACHE = ResultCache(os.path.join(STATE_DIR, "cache"), args.max_age,
+            read=not args.no_cache)
+        return run_watch(args, checks, watcher)
+
+    # Only a single run has a deadline, the daemon runs for good.
+    if args.deadline is not None:
+        DEADLINE = time.time() + args.deadline
+    if args.record is not None and args.replay is not None:
+        parser.error("--record and --replay cannot be combined")
+    # Bundles hold what the system says now, not what it said earlier.
+    if args.record is None and args.replay is None:
+        CACHE = ResultCache(os.path.join(STATE_DIR, "cache"), args.max_age,
+            read=not args.no_cache)
+    if args.record is not None:
+        BasicSystemSanity.facts = RecordingFactStore()
+        try:
+            return run_profiled(args)
+        finally:
+            BasicSystemSanity.facts.save(args.record)
+    if args.replay is not None:
+        BasicSystemSanity.facts = ReplayFactStore(args.replay)
+    return run_profiled(args)
 
 if __name__ == '__main__':
-    suite = unittest.TestLoader().loadTestsFromTestCase(BasicSystemSanity)
-    unittest.TextTestRunner(verbosity=2, resultclass=CustomTextTestResult).run(suite)
+    sys.exit(main())